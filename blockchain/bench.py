@@ -0,0 +1,274 @@
+"""
+Benchmarks for the hot paths. Run `python bench.py` for all of them or
+`python bench.py mining` for a single one. Keys, payloads and timestamps come
+from a fixed seed, so the same blocks get mined and validated every run and
+the figures of two runs, e.g. with `--json` before and after a change, can be
+compared line by line.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import time
+
+import sys
+sys.path.insert(0, '../')
+
+from blockchain.block import Block, ZERO_HASH
+from blockchain.chain import Chain
+from blockchain import key as key_module
+from blockchain.key import Key
+from blockchain.miner import Miner, search
+from blockchain.node import Node
+from blockchain.transaction import Transaction, verified_signatures
+
+#: a difficulty no search will ever satisfy, so every nonce gets tried
+IMPOSSIBLE = 64
+SEED = 1
+#: timestamp of the first benchmark block, the next ones follow by the second
+EPOCH = 1500000000
+#: print one JSON document per figure instead of a table
+json_output = False
+
+
+def report(name, value, unit):
+    if json_output:
+        print(json.dumps({'name': name, 'value': round(value, 1),
+                          'unit': unit.split()[0]}))
+    else:
+        print('%-40s %14.1f %s' % (name, value, unit))
+
+
+def bench_mining(attempts=200000):
+    """
+    Hashrate with 1, 2, 4 ... workers, up to one per core
+    """
+    workers, counts = 1, []
+    while workers < multiprocessing.cpu_count():
+        counts.append(workers)
+        workers *= 2
+    counts.append(multiprocessing.cpu_count())
+    base = None
+    for workers in counts:
+        miner = Miner(workers)
+        #: warm the pool up
+        miner.mine(Block(0, 0, []), IMPOSSIBLE, attempts=workers)
+        start_t = time.time()
+        miner.mine(Block(0, 0, []), IMPOSSIBLE, attempts=attempts)
+        rate = attempts / (time.time() - start_t)
+        miner.close()
+        base = base or rate
+        report('mining workers=%d' % workers, rate, 'H/s (x%.2f)' % (
+            rate / base))
+
+
+def bench_midstate(attempts=200000):
+    """
+    Hashing the whole header per nonce versus feeding the nonce to a copy of
+    the hashed prefix
+    """
+    header = Block(0, 0, []).header
+    start_t = time.time()
+    for nonce in range(attempts):
+        header.nonce = nonce
+        Block.proof_of_work(header, IMPOSSIBLE)
+    before = attempts / (time.time() - start_t)
+    report('full header hash per nonce', before, 'H/s')
+    start_t = time.time()
+    search(header, 0, attempts, IMPOSSIBLE)
+    after = attempts / (time.time() - start_t)
+    report('midstate copy per nonce', after, 'H/s (x%.2f)' % (after / before))
+
+
+def make_transactions(count):
+    sender, recipient = Key(), Key()
+    trxs = []
+    for idx in range(count):
+        trx = Transaction(sender.address, sender.public_key,
+                          recipient.address, 'message %d' % idx,
+                          nonce=idx)
+        #: a random signature nonce would change the blocks every run
+        trx.sign(sender.private_key, deterministic=True)
+        trxs.append(trx)
+    return trxs
+
+
+def make_block(trx_count):
+    return Block(1, Block(0, 0, [], timestamp=EPOCH).hash,
+                 make_transactions(trx_count), timestamp=EPOCH + 1)
+
+
+def timeit(func, rounds):
+    start_t = time.time()
+    for _ in range(rounds):
+        func()
+    return (time.time() - start_t) / rounds
+
+
+def bench_difficulty(difficulties=(1, 2, 3, 4), attempts=200000):
+    """
+    Node.mine_block in-process at increasing difficulties, over enough blocks
+    for about the same number of hashes at each
+    """
+    miner = Miner(1)
+    for difficulty in difficulties:
+        prev_hash, hashes, blocks = Block(0, 0, [], timestamp=EPOCH).hash, 0, 0
+        start_t = time.time()
+        while hashes < attempts:
+            Block.difficulty = difficulty
+            try:
+                block = Node.mine_block(blocks + 1, prev_hash, [], miner,
+                                        timestamp=EPOCH + blocks + 1)
+            finally:
+                Block.difficulty = 1
+            prev_hash, hashes, blocks = block.hash, hashes + block.nonce + 1, \
+                blocks + 1
+        rate = hashes / (time.time() - start_t)
+        report('mine_block difficulty=%d' % difficulty, rate,
+               'H/s (%d blocks, %d hashes)' % (blocks, hashes))
+
+
+def bench_verify(count=200):
+    """
+    Transaction.is_valid of new transactions, and of ones verified before
+    """
+    trxs = make_transactions(count)
+    verified_signatures.clear()
+    start_t = time.time()
+    assert all(trx.is_valid() for trx in trxs)
+    cold = count / (time.time() - start_t)
+    report('is_valid new', cold, 'verifies/s')
+    start_t = time.time()
+    assert all(trx.is_valid() for trx in trxs)
+    warm = count / (time.time() - start_t)
+    report('is_valid cached', warm, 'verifies/s (x%.2f)' % (warm / cold))
+
+
+def bench_hash(counts=(0, 10, 100, 1000), rounds=200):
+    """
+    Block.hash of a new block, merkle root included, by transaction count
+    """
+    trxs = make_transactions(max(counts))
+    for count in counts:
+        def new_block():
+            return Block(1, ZERO_HASH, trxs[:count], timestamp=EPOCH).hash
+        report('block hash trxs=%d' % count, timeit(new_block, rounds) * 1e6,
+               'us')
+
+
+def make_chain(height, trx_per_block=2):
+    trxs = make_transactions((height - 1) * trx_per_block)
+    chain = Chain()
+    chain.add_block(Node.mine_block(0, 0, [], timestamp=EPOCH))
+    for idx in range(1, height):
+        chain.add_block(Node.mine_block(
+            idx, chain.last_block.hash,
+            trxs[(idx - 1) * trx_per_block:idx * trx_per_block],
+            timestamp=EPOCH + idx))
+    return chain
+
+
+def bench_chain(heights=(10, 100, 500), rounds=3):
+    """
+    Chain.is_valid of a whole chain, signatures not verified before, by
+    height
+    """
+    for height in heights:
+        blocks = make_chain(height).blocks
+
+        def validate():
+            verified_signatures.clear()
+            assert Chain(blocks).is_valid()
+        report('chain is_valid height=%d' % height,
+               timeit(validate, rounds) * 1e3, 'ms')
+
+
+def bench_json(counts=(10, 100, 1000), rounds=20):
+    """
+    Block.from_json of a serialized block, parsing included, by transaction
+    count
+    """
+    for count in counts:
+        data = json.dumps(make_block(count).json())
+        report('block from_json trxs=%d' % count,
+               timeit(lambda: Block.from_json(json.loads(data)), rounds) * 1e6,
+               'us')
+
+
+def bench_codec(trx_count=100, rounds=200):
+    """
+    Size and encode/decode time of a block, JSON versus binary
+    """
+    block = make_block(trx_count)
+    as_json = json.dumps(block.json(), sort_keys=True).encode()
+    as_binary = block.encode()
+    report('block size json', len(as_json), 'bytes')
+    report('block size binary', len(as_binary), 'bytes (x%.2f)' % (
+        len(as_json) / len(as_binary)))
+    for name, encode, decode, data in (
+            ('json', lambda: json.dumps(block.json(), sort_keys=True),
+             lambda: Block.from_json(json.loads(as_json)), as_json),
+            ('binary', block.encode, lambda: Block.decode(as_binary),
+             as_binary)):
+        report('block encode %s' % name, timeit(encode, rounds) * 1e6, 'us')
+        report('block decode %s' % name, timeit(decode, rounds) * 1e6, 'us')
+
+
+def bench_keys(rounds=100):
+    """
+    Signing and verifying for a repeat sender, parsing the keys every time
+    versus the parsed and precomputed keys from the caches
+    """
+    key = Key()
+    data = b'Hello world'
+    signature = key.sign(data)
+    caches = (key_module._signing_keys, key_module._verifying_keys)
+
+    def cold(func):
+        def run():
+            for cache in caches:
+                cache.clear()
+            func()
+        return run
+
+    def sign():
+        Key(key.private_key).sign(data)
+
+    def verify():
+        Key.verify_by_public_key(data, signature, key.public_key)
+
+    for name, func in (('sign', sign), ('verify', verify)):
+        before = timeit(cold(func), rounds)
+        after = timeit(func, rounds)
+        report('%s parsing the key' % name, before * 1e6, 'us')
+        report('%s with the cached key' % name, after * 1e6, 'us (x%.2f)' % (
+            before / after))
+
+
+BENCHMARKS = {
+    'mining': bench_mining,
+    'midstate': bench_midstate,
+    'difficulty': bench_difficulty,
+    'verify': bench_verify,
+    'hash': bench_hash,
+    'chain': bench_chain,
+    'json': bench_json,
+    'codec': bench_codec,
+    'keys': bench_keys,
+}
+
+
+if __name__ == '__main__':
+    arger = argparse.ArgumentParser()
+    arger.add_argument('names', nargs='*',
+                       help='any of %s, all by default' %
+                       ', '.join(BENCHMARKS))
+    arger.add_argument('--seed', type=int, default=SEED)
+    arger.add_argument('--json', action='store_true',
+                       help='one JSON document per figure')
+    args = arger.parse_args()
+    json_output = args.json
+    for name in args.names or BENCHMARKS:
+        #: every benchmark gets the same keys whatever ran before it
+        random.seed(args.seed)
+        BENCHMARKS[name]()
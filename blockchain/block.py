@@ -1,59 +1,211 @@
-import json
+import time
 import _sha256
 
+from blockchain.codec import U32, U64, Reader, pack_bytes
 from blockchain.transaction import Transaction
+from merkletree.merkle_tree import MerkleTree
+
+#: prev_hash of the genesis block, and merkle root of an empty block
+ZERO_HASH = '0' * 64
+
+
+class BlockHeader(object):
+    """
+    The fixed-size part of a block that gets hashed. It commits to the
+    transactions only through their merkle root.
+    """
+    __slots__ = ('index', 'prev_hash', 'merkle_root', 'timestamp', 'nonce',
+                 '_hash')
+
+    #: index, prev_hash, merkle_root, timestamp and nonce
+    SIZE = U64.size + 32 + 32 + U64.size + U64.size
+
+    def __init__(self, index, prev_hash, merkle_root, timestamp, nonce=0):
+        self.index = index
+        self.prev_hash = prev_hash
+        self.merkle_root = merkle_root
+        self.timestamp = timestamp
+        self.nonce = nonce
+        #: (nonce, hash) of the last hash made
+        self._hash = None
+
+    @staticmethod
+    def from_json(doc):
+        return BlockHeader(doc['index'], doc['prev_hash'], doc['merkle_root'],
+                           doc['timestamp'], doc['nonce'])
+
+    def json(self):
+        return {
+            'index': self.index,
+            'prev_hash': self.prev_hash,
+            'merkle_root': self.merkle_root,
+            'timestamp': self.timestamp,
+            'nonce': self.nonce,
+        }
+
+    def prefix(self):
+        """
+        The encoded header without the nonce, which always goes last so
+        miners can hash this once and only feed the nonce per attempt
+        :return: <bytes>
+        """
+        return U64.pack(self.index) + bytes.fromhex(self.prev_hash) + \
+            bytes.fromhex(self.merkle_root) + U64.pack(self.timestamp)
+
+    @staticmethod
+    def nonce_bytes(nonce):
+        return U64.pack(nonce)
+
+    def encode(self):
+        """
+        :return: <bytes> SIZE bytes
+        """
+        return self.prefix() + self.nonce_bytes(self.nonce)
+
+    @staticmethod
+    def decode(data):
+        reader = Reader(data)
+        header = BlockHeader(reader.u64(), reader.read(32).hex(),
+                             reader.read(32).hex(), reader.u64(), reader.u64())
+        reader.done()
+        return header
+
+    @property
+    def hash(self):
+        """
+        Make a hash, remembered until the nonce changes
+        :return: <str>
+        """
+        if not self._hash or self._hash[0] != self.nonce:
+            self._hash = (self.nonce,
+                          _sha256.sha256(self.encode()).hexdigest())
+        return self._hash[1]
 
 
 class Block(object):
     """The block structure"""
+    __slots__ = ('header', 'transactions')
+
     difficulty = 1
 
-    def __init__(self, index, prev_hash, transactions, nonce=0):
-        self.index = index
-        self.nonce = nonce
-        self.prev_hash = prev_hash
+    def __init__(self, index, prev_hash, transactions, nonce=0,
+                 timestamp=None, merkle_root=None):
         self.transactions = transactions
+        if merkle_root is None:
+            merkle_root = Block.merkle_root_of(transactions)
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.header = BlockHeader(index, prev_hash or ZERO_HASH, merkle_root,
+                                  timestamp, nonce)
+
+    @property
+    def index(self):
+        return self.header.index
+
+    @property
+    def prev_hash(self):
+        return self.header.prev_hash
+
+    @property
+    def merkle_root(self):
+        return self.header.merkle_root
+
+    @property
+    def timestamp(self):
+        return self.header.timestamp
+
+    @property
+    def nonce(self):
+        return self.header.nonce
+
+    @nonce.setter
+    def nonce(self, nonce):
+        self.header.nonce = nonce
 
     def increase_nonce(self):
-        self.nonce += 1
+        self.header.nonce += 1
+
+    def proof(self, pos):
+        """
+        The merkle audit path of the transaction at pos
+        :return: <list> of (hash, 'l' or 'r'), see MerkleTree.proof
+        """
+        return MerkleTree.from_hashes([trx.txid for trx in
+                                       self.transactions]).proof(pos)
+
+    @staticmethod
+    def merkle_root_of(transactions):
+        """
+        The merkle root over the signed transactions
+        :return: <str>
+        """
+        if not transactions:
+            return ZERO_HASH
+        #: the leaves are the txids, no need to hash the transactions again
+        return MerkleTree.from_hashes(
+            [trx.txid for trx in transactions]).root.val
 
     @staticmethod
     def from_json(doc):
         trxs = [Transaction(**tdoc) for tdoc in doc['transactions']]
-        return Block(doc['index'], doc['prev_hash'], trxs, doc['nonce'])
+        return Block(doc['index'], doc['prev_hash'], trxs, doc['nonce'],
+                     doc.get('timestamp'), doc.get('merkle_root'))
+
+    def encode(self):
+        """
+        The canonical binary encoding: the header, then the transactions
+        :return: <bytes>
+        """
+        return self.header.encode() + U32.pack(len(self.transactions)) + \
+            b''.join(pack_bytes(trx.encode(True)) for trx in self.transactions)
+
+    @staticmethod
+    def decode(data):
+        """
+        :raise CodecError: for malformed data
+        """
+        reader = Reader(data)
+        header = BlockHeader.decode(reader.read(BlockHeader.SIZE))
+        trxs = [Transaction.decode(reader.bytes())
+                for _ in range(reader.u32())]
+        reader.done()
+        return Block(header.index, header.prev_hash, trxs, header.nonce,
+                     header.timestamp, header.merkle_root)
 
     def json(self):
-        return {
-            'index': self.index,
-            'nonce': self.nonce,
-            'prev_hash': self.prev_hash,
-            'transactions': [trx.json(with_sign=True) for trx in
-                             self.transactions]
-        }
+        doc = self.header.json()
+        doc['transactions'] = [trx.json(with_sign=True) for trx in
+                               self.transactions]
+        return doc
 
     @property
     def hash(self):
         """
-        Make a hash
+        Make a hash of the header
         :return: <str>
         """
-        doc = self.json()
-        block_str = json.dumps(doc, sort_keys=True, ensure_ascii=False)
-        return _sha256.sha256(block_str.encode()).hexdigest()
+        return self.header.hash
 
     def is_valid(self):
         """
         Whether it is a valid block
         :return: <Bool>
         """
-        return all([trx.is_valid() for trx in self.transactions])\
+        return self.body_matches() \
+            and all(Transaction.verify_batch(self.transactions))\
             and Block.proof_of_work(self, Block.difficulty)
 
+    def body_matches(self):
+        """
+        Whether the transactions are the ones the merkle root commits to
+        """
+        return self.merkle_root == Block.merkle_root_of(self.transactions)
+
     @staticmethod
     def proof_of_work(block, difficulty):
         """
         Whether the length of proceeding 0s is difficulty
-        :param block: <Block>
+        :param block: <Block> or <BlockHeader>
         :param difficulty: <Integer> length of proceeding zeros
         :return: <Bool>
         """
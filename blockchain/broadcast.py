@@ -0,0 +1,123 @@
+"""
+Non-blocking fan-out to the peers. Every peer has a bounded send queue drained
+by its own coroutine over a keep-alive HTTP session; the blocking posts run on
+a bounded thread pool so handlers only ever enqueue.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue, QueueFull
+
+from blockchain import metrics
+
+
+class Peer(object):
+    """
+    A peer we send to
+    """
+
+    def __init__(self, url, executor, queue_size=100, timeout=5, retries=2,
+                 backoff=0.5):
+        self.url = url
+        self.executor = executor
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        #: connections are kept alive and reused
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=2))
+        self.queue = Queue(maxsize=queue_size)
+        #: messages dropped because the queue was full, or failed for good
+        self.dropped = 0
+        self.sent = 0
+
+    def send(self, path, data, headers=None):
+        """
+        Queue a message without waiting
+        :return: <Bool> False if the queue is full and it got dropped
+        """
+        try:
+            self.queue.put_nowait((path, data, headers or {},
+                                   time.perf_counter()))
+            return True
+        except QueueFull:
+            self.dropped += 1
+            metrics.broadcast_dropped.inc()
+            logging.warning('send queue of %s is full, dropping %s', self.url,
+                            path)
+            return False
+
+    async def _post(self, path, data, headers):
+        post = partial(self.session.post, self.url + path, data=data,
+                       headers=headers, timeout=self.timeout)
+        res = await IOLoop.current().run_in_executor(self.executor, post)
+        res.raise_for_status()
+
+    async def run(self):
+        """
+        Drain the queue, retrying failed posts with an exponential backoff
+        """
+        while True:
+            path, data, headers, queued_t = await self.queue.get()
+            try:
+                for attempt in range(self.retries + 1):
+                    try:
+                        await self._post(path, data, headers)
+                        self.sent += 1
+                        metrics.broadcast_seconds.observe(
+                            time.perf_counter() - queued_t)
+                        break
+                    except requests.RequestException as e:
+                        logging.warning('failed to send %s to %s: %s', path,
+                                        self.url, e)
+                        if attempt == self.retries:
+                            self.dropped += 1
+                            metrics.broadcast_dropped.inc()
+                        else:
+                            await gen.sleep(self.backoff * 2 ** attempt)
+            finally:
+                self.queue.task_done()
+
+
+class Broadcaster(object):
+    """
+    Sends messages to all the peers
+    """
+
+    def __init__(self, peers, concurrency=8, **kwargs):
+        """
+        :param concurrency: most posts in flight at once, over all the peers
+        :param kwargs: see Peer
+        """
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.peers = [Peer(url, self.executor, **kwargs) for url in peers]
+        self._started = False
+
+    def _start(self):
+        for peer in self.peers:
+            IOLoop.current().spawn_callback(peer.run)
+        self._started = True
+
+    def send(self, path, data, headers=None, to=None):
+        """
+        Queue a message for the peers
+        :param to: urls of the peers to send to, all of them if None
+        :return: <Integer> how many peers it was queued for
+        """
+        if not self._started:
+            self._start()
+        return sum(peer.send(path, data, headers) for peer in self.peers
+                   if to is None or peer.url in to)
+
+    async def flush(self):
+        """
+        Wait for every queued message to be sent or given up on
+        """
+        await gen.multi([peer.queue.join() for peer in self.peers])
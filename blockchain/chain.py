@@ -1,8 +1,184 @@
+import logging
+
+from blockchain.block import Block
+from blockchain.store import PrunedError
+from blockchain.transaction import Transaction
+
+#: side branches forking deeper below the tip are dropped
+MAX_FORK_DEPTH = 100
+
 
 class Chain(object):
-    """The chain"""
-    def __init__(self):
-        self.blocks = []
+    """
+    The chain. Remembers how far it has been validated, so appends and reorgs
+    only validate the new blocks. Blocks of side branches are kept too, the
+    chain switches to a branch once it carries more work, disconnecting and
+    connecting only the blocks past the fork. With a State, blocks are only
+    connected if their transactions apply to it. With a pruned BlockStore,
+    the bodies of the blocks older than the latest keep, and than the latest
+    snapshot of the state, are dropped and the headers stay.
+    """
+    def __init__(self, blocks=None, checkpoints=None, validated=False,
+                 state=None):
+        """
+        :param blocks: <list> or <BlockStore>
+        :param validated: whether the blocks were validated before, e.g.
+                          when they were stored
+        :param state: <State> kept at the tip, if any
+        """
+        #: {height: hash} of blocks trusted without re-verifying them
+        self.checkpoints = checkpoints or {}
+        self.blocks = blocks if blocks is not None else []
+        keep = getattr(self.blocks, 'keep', None)
+        if keep is not None and keep <= MAX_FORK_DEPTH:
+            raise ValueError('a pruned chain keeps more than %d blocks' %
+                             MAX_FORK_DEPTH)
+        if validated:
+            self.validated_height = self.height
+        self.state = state
+        if state:
+            self._catch_up_state()
+
+    @property
+    def blocks(self):
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks):
+        self._blocks = blocks
+        #: blocks[:validated_height] are known to be valid
+        self.validated_height = 0
+        #: hash -> <Block> of the valid blocks off the chain
+        self._side = {}
+        self._reset_indexes()
+
+    def _catch_up_state(self):
+        """
+        Bring the state, e.g. a snapshot from disk, to the tip
+        """
+        state = self.state
+        if state.height > self.height or (state.height and self.header(
+                state.height-1).hash != state.block_hash):
+            logging.warning('the state is not of this chain, rebuilding it')
+            state.reset()
+        if state.height < self.pruned_height:
+            raise PrunedError('the state is at height %d, the bodies to '
+                              'replay are pruned below %d' %
+                              (state.height, self.pruned_height))
+        for height in range(state.height, self.height):
+            if not state.apply(self.blocks[height]):
+                raise ValueError('block %d does not apply to the state' %
+                                 height)
+
+    def _reset_indexes(self):
+        #: block hash -> height, built from the headers alone
+        self._block_index = {}
+        #: blocks[:indexed_height] are in the block index
+        self._indexed_height = 0
+        #: txid -> (height, position)
+        self._trx_index = {}
+        #: address -> [txid]
+        self._address_index = {}
+        #: the transactions of blocks[:trx_indexed_height] are indexed. Only
+        #: caught up by the lookups needing them, as it reads every body
+        self._trx_indexed_height = 0
+
+    @property
+    def pruned_height(self):
+        """
+        The bodies of the blocks below it are gone, their headers stay
+        """
+        return getattr(self.blocks, 'pruned_height', 0)
+
+    def header(self, height):
+        """
+        :return: <BlockHeader> of the block at height, pruned or not
+        """
+        if isinstance(self.blocks, list):
+            return self.blocks[height].header
+        return self.blocks.header(height)
+
+    def headers(self, start, stop):
+        """
+        :return: <list> of <BlockHeader> of the blocks [start, stop)
+        """
+        if isinstance(self.blocks, list):
+            return [block.header for block in self.blocks[start:stop]]
+        return self.blocks.headers(start, stop)
+
+    def _index(self):
+        """
+        Catch the block index up with the blocks, from their headers
+        """
+        start = self._indexed_height
+        for height, header in enumerate(self.headers(start, self.height),
+                                        start):
+            self._block_index[header.hash] = height
+        self._indexed_height = self.height
+
+    def _index_transactions(self):
+        """
+        Catch the transaction indexes up with the bodies we have
+        """
+        start = max(self._trx_indexed_height, self.pruned_height)
+        for height in range(start, self.height):
+            for pos, trx in enumerate(self.blocks[height].transactions):
+                self._trx_index[trx.txid] = (height, pos)
+                for address in {trx.sender, trx.recipient}:
+                    self._address_index.setdefault(address, []).append(
+                        trx.txid)
+        self._trx_indexed_height = self.height
+
+    def _unindex(self, height):
+        """
+        Drop blocks[height:] from the indexes
+        """
+        for header in self.headers(height, self._indexed_height):
+            self._block_index.pop(header.hash, None)
+        for block in self.blocks[height:self._trx_indexed_height]:
+            self._unindex_transactions(block)
+        self._indexed_height = min(self._indexed_height, height)
+        self._trx_indexed_height = min(self._trx_indexed_height, height)
+
+    def _unindex_transactions(self, block):
+        for trx in block.transactions:
+            self._trx_index.pop(trx.txid, None)
+            for address in {trx.sender, trx.recipient}:
+                txids = self._address_index.get(address, [])
+                if trx.txid in txids:
+                    txids.remove(trx.txid)
+                if not txids:
+                    self._address_index.pop(address, None)
+
+    def block_by_hash(self, block_hash):
+        """
+        :return: <Block> None if it is not in the chain
+        :raise PrunedError: if its body is pruned
+        """
+        self._index()
+        height = self._block_index.get(block_hash)
+        return self.blocks[height] if height is not None else None
+
+    def knows(self, block_hash):
+        """
+        Whether the block is in the chain or a side branch
+        """
+        self._index()
+        return block_hash in self._side or block_hash in self._block_index
+
+    def find_transaction(self, txid):
+        """
+        :return: (height, position) of the transaction, None if not found
+        """
+        self._index_transactions()
+        return self._trx_index.get(txid)
+
+    def transactions_of(self, address):
+        """
+        :return: <list> txids sent from or to the address, oldest first
+        """
+        self._index_transactions()
+        return list(self._address_index.get(address, []))
 
     @property
     def last_block(self):
@@ -12,21 +188,284 @@ class Chain(object):
     def height(self):
         return len(self.blocks)
 
-    def is_valid(self):
+    def vouched(self, headers):
         """
-        Validate the chain
+        How many of the leading headers a matching checkpoint vouches for
+        :param headers: <list> of <BlockHeader> or <Block> in a row
+        """
+        if not headers:
+            return 0
+        first, count = headers[0].index, 0
+        for height, block_hash in self.checkpoints.items():
+            if first <= height < first + len(headers) and \
+                    headers[height-first].hash == block_hash:
+                count = max(count, height - first + 1)
+        return count
+
+    @staticmethod
+    def _validate(blocks, parent=None, vouched=0):
         """
-        for idx, block in enumerate(self.blocks):
-            if not block.is_valid():
+        Validate blocks extending parent. The signatures are verified in one
+        parallel batch up front, linking the hashes stays sequential. The
+        first vouched blocks only need to link up and match their merkle
+        root, they carry no signature or proof of work to check
+        """
+        trxs = [trx for block in blocks[vouched:]
+                for trx in block.transactions]
+        if not all(Transaction.verify_batch(trxs)):
+            return False
+        for idx, block in enumerate(blocks):
+            if not (block.body_matches() if idx < vouched else
+                    block.is_valid()):
                 return False
-            if idx != 0 and self.blocks[idx-1].hash != block.prev_hash:
+            if parent and parent.hash != block.prev_hash:
                 return False
+            parent = block
+        return True
+
+    def is_valid(self):
+        """
+        Validate the chain from the validated height on
+        """
+        start = self.validated_height
+        blocks = self.blocks[start:]
+        parent = self.header(start-1) if start else None
+        if not Chain._validate(blocks, parent, self.vouched(blocks)):
+            return False
+        self.validated_height = self.height
+        return True
+
+    @staticmethod
+    def work(length):
+        """
+        The work of that many blocks, the hashes expected to redo them. All
+        the blocks have the same difficulty, so it grows with the length
+        """
+        return length * 16 ** Block.difficulty
+
+    def extend(self, blocks, vouched=None):
+        """
+        Append blocks extending the tip, validated in one go
+        :param vouched: how many of the first ones a checkpoint vouches for,
+                        e.g. found by a headers-first sync. From the
+                        checkpoints among blocks if None
+        :return: <Bool> whether they were all appended
+        """
+        fork = self.height
+        if not blocks or blocks[0].index != fork:
+            return False
+        if vouched is None:
+            vouched = self.vouched(blocks)
+        if not Chain._validate(blocks, self.last_block, vouched):
+            return False
+        if self.state:
+            for block in blocks:
+                if not self.state.apply(block):
+                    self.state.rollback_to(fork, self)
+                    return False
+        validated = self.validated_height == fork
+        self.blocks.extend(blocks)
+        if validated:
+            self.validated_height = self.height
+        self._prune_side()
+        self._prune()
         return True
 
     def add_block(self, block):
-        if block.is_valid():
-            if not self.last_block:
-                self.blocks.append(block)
-            elif self.last_block.hash == block.prev_hash:
-                self.blocks.append(block)
+        """
+        Add a block extending the tip, or a side branch
+        :return: <Bool> whether it is on the chain now
+        """
+        accepted = self.accept(block)
+        return bool(accepted and accepted[1])
+
+    def accept(self, block):
+        """
+        Add a block extending the tip or a side branch, switching to the
+        branch if it then has more work than the chain past the fork
+        :return: (disconnected blocks, connected blocks), both empty if the
+                 block went to a side branch. None if it was known already,
+                 invalid or its parent is unknown
+        """
+        if self.knows(block.hash):
+            return None
+        if not self.last_block or self.last_block.hash == block.prev_hash:
+            if block.index != self.height or not block.is_valid() or \
+                    (self.state and not self.state.apply(block)):
+                return None
+            if self.validated_height == self.height:
+                self.validated_height += 1
+            self.blocks.append(block)
+            self._prune_side()
+            self._prune()
+            return [], [block]
+        #: walk back the side branch to the chain
+        branch, parent_hash = [block], block.prev_hash
+        while parent_hash in self._side:
+            branch.append(self._side[parent_hash])
+            parent_hash = branch[-1].prev_hash
+        #: from the headers, the parent's body may be pruned
+        self._index()
+        parent_height = self._block_index.get(parent_hash)
+        if parent_height is None:
+            return None
+        fork = parent_height + 1
+        if block.index != fork + len(branch) - 1 or \
+                self.height - fork > MAX_FORK_DEPTH or not block.is_valid():
+            return None
+        self._side[block.hash] = block
+        if Chain.work(len(branch)) <= Chain.work(self.height - fork):
+            return [], []
+        branch.reverse()
+        rejected = self._switch_state(fork, branch)
+        if rejected is not None:
+            #: and whatever builds on it
+            for dropped in branch[rejected:]:
+                del self._side[dropped.hash]
+            return None
+        return self._reorganize(fork, branch), branch
+
+    def _switch_state(self, fork, blocks):
+        """
+        Move the state over to blocks from height fork on. If one of them
+        does not apply, the state is moved back to the tip
+        :return: <Integer> the position of the block that does not apply,
+                 None if they all do
+        """
+        if not self.state:
+            return None
+        if not self.state.reaches(fork, self.pruned_height):
+            logging.warning('cannot roll the state back to %d, the blocks '
+                            'are pruned below %d', fork, self.pruned_height)
+            return 0
+        self.state.rollback_to(fork, self)
+        for pos, block in enumerate(blocks):
+            if not self.state.apply(block):
+                self.state.rollback_to(fork, self)
+                for height in range(fork, self.height):
+                    self.state.apply(self.blocks[height])
+                return pos
+        return None
+
+    def _reorganize(self, fork, blocks):
+        """
+        Replace the blocks from height fork on with blocks, both validated,
+        the replaced ones go to the side branches
+        :return: <list> the blocks disconnected
+        """
+        disconnected = self.blocks[fork:]
+        validated = self.validated_height >= fork
+        self._unindex(fork)
+        del self.blocks[fork:]
+        self.blocks.extend(blocks)
+        if validated:
+            self.validated_height = self.height
+        for block in disconnected:
+            self._side[block.hash] = block
+        for block in blocks:
+            self._side.pop(block.hash, None)
+        self._prune_side()
+        self._prune()
+        return disconnected
+
+    def _prune_side(self):
+        lowest = self.height - MAX_FORK_DEPTH
+        for block_hash in [block_hash for block_hash, block in
+                           self._side.items() if block.index < lowest]:
+            del self._side[block_hash]
+
+    def _prune(self):
+        """
+        Drop the bodies below the latest keep blocks from a pruned store,
+        keeping the ones the state replays from its latest snapshot
+        """
+        keep = getattr(self.blocks, 'keep', None)
+        if not keep:
+            return
+        height = self.height - keep
+        if self.state:
+            height = min(height, self.state.snapshot_height)
+        if height <= self.pruned_height:
+            return
+        for block in self.blocks[self.pruned_height:
+                                 min(height, self._trx_indexed_height)]:
+            self._unindex_transactions(block)
+        self.blocks.prune(height)
+
+    def locator(self):
+        return [self.header(height).hash
+                for height in Chain.locator_heights(self.height)]
+
+    @staticmethod
+    def locator_of(blocks):
+        """
+        Hashes of the blocks (or headers) walking back from the tip
+        :return: <list>
+        """
+        return [blocks[height].hash
+                for height in Chain.locator_heights(len(blocks))]
+
+    @staticmethod
+    def locator_heights(length):
+        """
+        The heights of a locator, one by one for the latest ten then
+        doubling the step, always ending with the genesis
+        :return: <list>
+        """
+        heights, height, step = [], length - 1, 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= 10:
+                step *= 2
+            height -= step
+        if length:
+            heights.append(0)
+        return heights
 
+    def locate(self, locator):
+        """
+        The height following the first block of the locator we have too
+        :return: <Integer> 0 if we have none of them
+        """
+        self._index()
+        for block_hash in locator:
+            height = self._block_index.get(block_hash)
+            if height is not None:
+                return height + 1
+        return 0
+
+    def fork_point(self, blocks):
+        """
+        The first height at which blocks differs from the chain
+        """
+        height = min(self.height, len(blocks))
+        while height and self.header(height-1).hash != blocks[height-1].hash:
+            height -= 1
+        return height
+
+    def replace(self, blocks):
+        """
+        Switch to a longer chain. Only the blocks after the fork point are
+        validated
+        :return: <Bool> whether it was replaced
+        """
+        if len(blocks) <= self.height:
+            return False
+        fork = self.fork_point(blocks)
+        return self.switch(fork, blocks[fork:]) is not None
+
+    def switch(self, fork, blocks):
+        """
+        Replace the blocks from height fork on, once the new ones are
+        validated
+        :param blocks: the new blocks from height fork on
+        :return: <list> the blocks disconnected, None if it was not switched
+        """
+        if fork < self.pruned_height or not self.is_valid():
+            return None
+        #: only its hash is needed, its body may be pruned
+        parent = self.header(fork-1) if fork else None
+        if not Chain._validate(blocks, parent, self.vouched(blocks)) or \
+                self._switch_state(fork, blocks) is not None:
+            return None
+        return self._reorganize(fork, blocks)
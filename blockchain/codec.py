@@ -0,0 +1,61 @@
+"""
+Primitives of the canonical binary encoding. Integers are big-endian and of
+fixed width, variable sized fields are prefixed with their length.
+"""
+import struct
+
+#: content type of the encoded objects sent between peers
+BINARY = 'application/octet-stream'
+
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+
+
+class CodecError(ValueError):
+    """Malformed binary data"""
+
+
+def pack_bytes(data):
+    """
+    :return: <bytes> data prefixed with its length
+    """
+    return U32.pack(len(data)) + data
+
+
+class Reader(object):
+    """
+    Reads the fields back in order
+    """
+    __slots__ = ('data', 'pos')
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            raise CodecError('truncated data')
+        chunk, self.pos = self.data[self.pos:end], end
+        return chunk
+
+    def _unpack(self, fmt):
+        try:
+            value, = fmt.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise CodecError('truncated data')
+        self.pos += fmt.size
+        return value
+
+    def u32(self):
+        return self._unpack(U32)
+
+    def u64(self):
+        return self._unpack(U64)
+
+    def bytes(self):
+        return self.read(self._unpack(U32))
+
+    def done(self):
+        if self.pos != len(self.data):
+            raise CodecError('trailing data')
@@ -0,0 +1,109 @@
+"""
+Compact blocks: the header of a block and a short id per transaction, 6 bytes
+instead of the whole transaction. The ids are keyed with the block and a
+random salt, so nobody can make transactions collide with a block's in
+advance. The receiver rebuilds the block from its mempool and only fetches
+the transactions it misses.
+"""
+import hashlib
+import os
+
+from blockchain.block import Block, BlockHeader
+from blockchain.codec import U32, U64, Reader
+
+SHORT_ID_SIZE = 6
+
+
+class CompactBlock(object):
+    """
+    A block as relayed to peers that likely have its transactions
+    """
+    __slots__ = ('header', 'salt', 'short_ids', '_key')
+
+    def __init__(self, header, salt, short_ids):
+        self.header = header
+        self.salt = salt
+        self.short_ids = short_ids
+        #: of the keyed hash of the short ids
+        self._key = hashlib.sha256(header.encode() + U64.pack(salt)).digest()
+
+    @staticmethod
+    def from_block(block, salt=None):
+        if salt is None:
+            salt = U64.unpack(os.urandom(U64.size))[0]
+        compact = CompactBlock(block.header, salt, [])
+        compact.short_ids = [compact.short_id(trx.txid)
+                             for trx in block.transactions]
+        return compact
+
+    @property
+    def hash(self):
+        return self.header.hash
+
+    def short_id(self, txid):
+        return hashlib.blake2b(bytes.fromhex(txid), key=self._key,
+                               digest_size=SHORT_ID_SIZE).digest()
+
+    def encode(self):
+        """
+        The header, the salt, then the count and the short ids
+        :return: <bytes>
+        """
+        return self.header.encode() + U64.pack(self.salt) + \
+            U32.pack(len(self.short_ids)) + b''.join(self.short_ids)
+
+    @staticmethod
+    def decode(data):
+        """
+        :raise CodecError: for malformed data
+        """
+        reader = Reader(data)
+        header = BlockHeader.decode(reader.read(BlockHeader.SIZE))
+        salt = reader.u64()
+        short_ids = [reader.read(SHORT_ID_SIZE)
+                     for _ in range(reader.u32())]
+        reader.done()
+        return CompactBlock(header, salt, short_ids)
+
+    def match(self, transactions):
+        """
+        Fill in the transactions we have. An id matching two of them counts
+        as missing, the full transaction decides
+        :param transactions: the candidates, e.g. the mempool
+        :return: <list> of <Transaction> by position, None for the missing
+        """
+        ours = {}
+        for trx in transactions:
+            short_id = self.short_id(trx.txid)
+            ours[short_id] = None if short_id in ours else trx
+        return [ours.get(short_id) for short_id in self.short_ids]
+
+    def block(self, transactions):
+        """
+        :param transactions: all of them, in order
+        :return: <Block> None if they are not the ones the header commits to
+        """
+        if Block.merkle_root_of(transactions) != self.header.merkle_root:
+            return None
+        header = self.header
+        return Block(header.index, header.prev_hash, transactions,
+                     header.nonce, header.timestamp, header.merkle_root)
+
+
+def encode_indices(block_hash, indices):
+    """
+    A request for the transactions of a block at indices
+    """
+    return bytes.fromhex(block_hash) + U32.pack(len(indices)) + \
+        b''.join(U32.pack(idx) for idx in indices)
+
+
+def decode_indices(data):
+    """
+    :return: (block hash, <list> of indices)
+    """
+    reader = Reader(data)
+    block_hash = reader.read(32).hex()
+    indices = [reader.u32() for _ in range(reader.u32())]
+    reader.done()
+    return block_hash, indices
@@ -0,0 +1,330 @@
+"""
+Announce/pull gossip. A node announces the ids of the transactions new to it,
+in batched inventory messages; a peer pulls, from the announcer, only the ones
+it has neither seen nor has, and announces them in turn once they are
+accepted. A bounded set of recently seen ids stops the announcements from
+echoing, so every object crosses every node once whatever the number of
+peers. New blocks are pushed as compact blocks instead, which cost little more
+than an announcement as the peers have most of their transactions already.
+"""
+import logging
+import struct
+
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from blockchain import metrics
+from blockchain.block import Block
+from blockchain.cache import LRUCache
+from blockchain.codec import BINARY, CodecError, Reader, pack_bytes
+from blockchain.compact import CompactBlock, decode_indices, encode_indices
+from blockchain.store import PrunedError
+from blockchain.sync import Syncer
+from blockchain.transaction import Transaction
+
+BLOCK = 1
+TRANSACTION = 2
+#: <kind><hash> of an inventory entry
+ENTRY = struct.Struct('>B32s')
+#: most entries per inventory message
+MAX_ENTRIES = 1000
+
+
+def encode_inv(items):
+    """
+    :param items: [(kind, hex hash)]
+    """
+    return b''.join(ENTRY.pack(kind, bytes.fromhex(obj_hash))
+                    for kind, obj_hash in items)
+
+
+def decode_inv(data):
+    """
+    :return: <list> of (kind, hex hash)
+    """
+    reader, items = Reader(data), []
+    while reader.pos < len(data):
+        kind, obj_hash = ENTRY.unpack(reader.read(ENTRY.size))
+        items.append((kind, obj_hash.hex()))
+    return items
+
+
+class Gossip(object):
+    """
+    The gossip of a node with its peers
+    """
+
+    def __init__(self, node, broadcaster, url, seen_size=100000, timeout=10):
+        """
+        :param broadcaster: <Broadcaster> to the peers
+        :param url: of this node, peers pull from it
+        :param seen_size: how many recently seen ids are remembered
+        """
+        self.node = node
+        self.broadcaster = broadcaster
+        self.url = url
+        self.timeout = timeout
+        #: ids announced, being pulled or accepted lately
+        self.seen = LRUCache(seen_size)
+        #: [(kind, hash, peer it came from)] waiting to be announced
+        self._pending = []
+
+    def routes(self):
+        return [(r"/inv/", InvHandler, dict(gossip=self)),
+                (r"/getdata/", GetDataHandler, dict(gossip=self)),
+                (r"/cmpctblock/", CompactBlockHandler, dict(gossip=self)),
+                (r"/blocktxn/", BlockTransactionsHandler, dict(gossip=self))]
+
+    def announce_block(self, block, source=None):
+        """
+        Push the block to the peers but source as a compact block, saving the
+        round trip of an announcement
+        """
+        self.seen.put(block.hash, True)
+        self.broadcaster.send(
+            '/cmpctblock/', CompactBlock.from_block(block).encode(),
+            {'Content-Type': BINARY, 'X-Peer': self.url},
+            [peer.url for peer in self.broadcaster.peers
+             if peer.url != source])
+
+    def announce_transaction(self, trx, source=None):
+        self._announce(TRANSACTION, trx.txid, source)
+
+    def _announce(self, kind, obj_hash, source):
+        """
+        Queue an id for the peers but source, what gets announced in the same
+        IOLoop iteration goes in one message
+        """
+        self.seen.put(obj_hash, True)
+        if not self._pending:
+            IOLoop.current().add_callback(self._flush)
+        self._pending.append((kind, obj_hash, source))
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        for peer in self.broadcaster.peers:
+            items = [(kind, obj_hash) for kind, obj_hash, source in pending
+                     if source != peer.url]
+            for pos in range(0, len(items), MAX_ENTRIES):
+                self.broadcaster.send(
+                    '/inv/', encode_inv(items[pos:pos + MAX_ENTRIES]),
+                    {'Content-Type': BINARY, 'X-Peer': self.url}, [peer.url])
+
+    def is_peer(self, url):
+        """
+        Whether url is one of our peers, the only ones we pull from
+        """
+        return any(peer.url == url for peer in self.broadcaster.peers)
+
+    def _known(self, kind, obj_hash):
+        if kind == BLOCK:
+            return self.node.chain.knows(obj_hash)
+        #: not looked up on the chain, which would index every body; one
+        #: mined already is turned away by its nonce once pulled
+        return obj_hash in self.node.mempool
+
+    def receive(self, peer, items):
+        """
+        An inventory from peer, the entries new to us get pulled from it
+        :return: <list> of the entries pulled
+        """
+        wanted = []
+        for kind, obj_hash in items:
+            if kind in (BLOCK, TRANSACTION) and obj_hash not in self.seen \
+                    and not self._known(kind, obj_hash):
+                self.seen.put(obj_hash, True)
+                wanted.append((kind, obj_hash))
+        if wanted:
+            IOLoop.current().spawn_callback(self.pull, peer, wanted)
+        return wanted
+
+    def lookup(self, kind, obj_hash):
+        """
+        :return: <bytes> the encoding of the object, empty if we do not have
+                 it
+        """
+        if kind == BLOCK:
+            try:
+                block = self.node.chain.block_by_hash(obj_hash)
+            except PrunedError:
+                return b''
+            return block.encode() if block else b''
+        trx = self.node.mempool.get(obj_hash)
+        if not trx:
+            found = self.node.chain.find_transaction(obj_hash)
+            if found:
+                height, pos = found
+                trx = self.node.chain.blocks[height].transactions[pos]
+        return trx.encode(True) if trx else b''
+
+    async def pull(self, peer, items):
+        """
+        Fetch the objects from peer and accept the ones that are valid
+        """
+        try:
+            res = await AsyncHTTPClient().fetch(
+                peer + '/getdata/', method='POST', body=encode_inv(items),
+                headers={'Content-Type': BINARY, 'Accept': BINARY},
+                request_timeout=self.timeout)
+            reader = Reader(res.body)
+            payloads = [reader.bytes() for _ in items]
+            reader.done()
+        except Exception as e:
+            logging.warning('failed to pull %d objects from %s: %s',
+                            len(items), peer, e)
+            payloads = [b''] * len(items)
+        for (kind, obj_hash), payload in zip(items, payloads):
+            obj = None
+            if payload:
+                try:
+                    obj = Block.decode(payload) if kind == BLOCK else \
+                        Transaction.decode(payload)
+                except (CodecError, ValueError) as e:
+                    logging.warning('malformed object %s from %s: %s',
+                                    obj_hash, peer, e)
+                if obj and (obj.hash if kind == BLOCK else
+                            obj.txid) != obj_hash:
+                    logging.warning('got another object than %s from %s',
+                                    obj_hash, peer)
+                    obj = None
+            if not obj:
+                #: may be pulled from whoever announces it next
+                self.seen.pop(obj_hash)
+            elif kind == BLOCK:
+                await self._accept_block(obj, peer)
+            elif self.node.add_transaction(obj):
+                self.announce_transaction(obj, peer)
+
+    async def _accept_block(self, block, peer):
+        if self.node.add_block(block):
+            self.announce_block(block, peer)
+        elif block.index > self.node.chain.height and \
+                await Syncer(self.node, [peer]).sync():
+            #: we were missing its parents
+            self.announce_block(self.node.chain.last_block, peer)
+
+    def receive_compact(self, peer, compact):
+        """
+        A compact block from peer, rebuilt unless we have seen it. Its
+        header has to carry its proof of work before anything gets fetched
+        for it
+        :return: <Bool> whether it is new to us
+        """
+        if not Block.proof_of_work(compact.header, Block.difficulty) or \
+                compact.hash in self.seen or \
+                self.node.chain.knows(compact.hash):
+            return False
+        self.seen.put(compact.hash, True)
+        IOLoop.current().spawn_callback(self.complete, peer, compact)
+        return True
+
+    async def complete(self, peer, compact):
+        """
+        Rebuild the block from the mempool, the transactions missing from it
+        are fetched from peer. Falls back to pulling the whole block
+        """
+        trxs = compact.match(self.node.mempool)
+        missing = [idx for idx, trx in enumerate(trxs) if trx is None]
+        metrics.compact_missing.inc(len(missing))
+        if missing:
+            try:
+                res = await AsyncHTTPClient().fetch(
+                    peer + '/blocktxn/', method='POST',
+                    body=encode_indices(compact.hash, missing),
+                    headers={'Content-Type': BINARY, 'Accept': BINARY},
+                    request_timeout=self.timeout)
+                reader = Reader(res.body)
+                for idx in missing:
+                    trxs[idx] = Transaction.decode(reader.bytes())
+                reader.done()
+            except Exception as e:
+                logging.warning('failed to get %d transactions of block %s '
+                                'from %s: %s', len(missing), compact.hash,
+                                peer, e)
+                trxs = None
+        block = trxs and compact.block(trxs)
+        if not block:
+            #: colliding short ids, or the peer failed us
+            metrics.compact_blocks.inc(result='fallback')
+            await self.pull(peer, [(BLOCK, compact.hash)])
+            return
+        metrics.compact_blocks.inc(result='fetched' if missing else 'complete')
+        await self._accept_block(block, peer)
+
+    def block_transactions(self, block_hash, indices):
+        """
+        :return: <list> of the encodings of the transactions of the block at
+                 indices, None if we do not have them
+        """
+        try:
+            block = self.node.chain.block_by_hash(block_hash)
+        except PrunedError:
+            return None
+        if not block or not all(0 <= idx < len(block.transactions)
+                                for idx in indices):
+            return None
+        return [block.transactions[idx].encode(True) for idx in indices]
+
+
+class GossipHandler(tornado.web.RequestHandler):
+    def initialize(self, gossip):
+        self.gossip = gossip
+
+    def peer(self):
+        """
+        The peer the message is from, it gets pulled from so it has to be
+        one of ours
+        """
+        peer = self.request.headers.get('X-Peer')
+        if not peer:
+            raise tornado.web.HTTPError(400, 'X-Peer missing')
+        if not self.gossip.is_peer(peer):
+            raise tornado.web.HTTPError(403, 'unknown peer %s', peer)
+        return peer
+
+    def decode(self, decoder):
+        """
+        :return: the body decoded by decoder, 400 if it is malformed
+        """
+        try:
+            return decoder(self.request.body)
+        except CodecError as e:
+            raise tornado.web.HTTPError(400, 'malformed message: %s', e)
+
+
+class InvHandler(GossipHandler):
+    def post(self):
+        self.gossip.receive(self.peer(), self.decode(decode_inv))
+
+
+class CompactBlockHandler(GossipHandler):
+    def post(self):
+        self.gossip.receive_compact(self.peer(),
+                                    self.decode(CompactBlock.decode))
+
+
+class BlockTransactionsHandler(GossipHandler):
+    def post(self):
+        """
+        The transactions of a block at the indices asked for, length prefixed
+        """
+        trxs = self.gossip.block_transactions(
+            *self.decode(decode_indices))
+        if trxs is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', BINARY)
+        self.write(b''.join(pack_bytes(trx) for trx in trxs))
+
+
+class GetDataHandler(GossipHandler):
+    def post(self):
+        """
+        The objects of the inventory, length prefixed in the same order
+        """
+        items = self.decode(decode_inv)
+        if len(items) > MAX_ENTRIES:
+            raise tornado.web.HTTPError(400, 'too many entries')
+        self.set_header('Content-Type', BINARY)
+        self.write(b''.join(pack_bytes(self.gossip.lookup(kind, obj_hash))
+                            for kind, obj_hash in items))
@@ -2,10 +2,75 @@ import random
 import hashlib
 import ecdsa
 import binascii
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
+from ecdsa.ellipticcurve import PointJacobi
+from ecdsa.errors import MalformedPointError
+
+from blockchain.cache import LRUCache
 
 ADDRESS_MAGIC_BYTE = b'\x06'
 
+#: smaller batches are verified in process, a pool round trip costs more
+BATCH_MIN_SIZE = 32
+
+#: pools shared by every batch verification, by number of workers
+_verify_pools = {}
+
+
+def _get_verify_pool(workers):
+    if workers not in _verify_pools:
+        _verify_pools[workers] = ProcessPoolExecutor(workers)
+    return _verify_pools[workers]
+
+
+#: parsed keys by their hex encoding. Parsing a private key derives its public
+#: point, a scalar multiplication as costly as a signature
+_signing_keys = LRUCache(1024)
+#: public key -> [VerifyingKey, uses]
+_verifying_keys = LRUCache(4096)
+#: uses of a public key before it gets precomputation tables, which make its
+#: verifications faster but take a while to build
+PRECOMPUTE_AFTER = 3
+
+
+def _signing_key(private_key):
+    sk = _signing_keys.get(private_key)
+    if sk is None:
+        sk = ecdsa.keys.SigningKey.from_string(
+            binascii.unhexlify(private_key), Key._curve, Key._hash_function)
+        _signing_keys.put(private_key, sk)
+    return sk
+
+
+def _verifying_key(public_key):
+    entry = _verifying_keys.get(public_key)
+    if entry is None:
+        entry = [ecdsa.VerifyingKey.from_string(
+            binascii.unhexlify(public_key), Key._curve, Key._hash_function), 0]
+        _verifying_keys.put(public_key, entry)
+    entry[1] += 1
+    if entry[1] == PRECOMPUTE_AFTER:
+        #: a repeat sender. Parsed points do not know their order, which the
+        #: precomputation needs
+        point = entry[0].pubkey.point
+        entry[0] = ecdsa.VerifyingKey.from_public_point(
+            PointJacobi(Key._curve.curve, point.x(), point.y(), 1,
+                        Key._curve.order, generator=True),
+            Key._curve, Key._hash_function)
+        entry[0].precompute()
+    return entry[0]
+
+
+def _as_bytes(data):
+    return data.encode() if isinstance(data, str) else data
+
+
+def _verify_item(item):
+    data, signature, public_key = item
+    return Key.verify_by_public_key(data, signature, public_key)
+
 
 class Key(object):
     """
@@ -21,10 +86,8 @@ class Key(object):
                 seed, self._curve, self._hash_function
             )
         else:
-            self._private_key = ecdsa.keys.SigningKey.from_string(
-                binascii.unhexlify(private_key), self._curve,
-                self._hash_function
-            )
+            self._private_key = _signing_key(private_key)
+        self._public_key = None
 
     @property
     def private_key(self):
@@ -38,23 +101,31 @@ class Key(object):
         """
         :return: public key string
         """
-        ecdsa_public_key = self._private_key.get_verifying_key()
-        return ecdsa_public_key.to_string().hex()
+        if not self._public_key:
+            ecdsa_public_key = self._private_key.get_verifying_key()
+            self._public_key = ecdsa_public_key.to_string().hex()
+        return self._public_key
 
     @property
     def address(self):
         """
         :return: the address
         """
-        ecdsa_public_key = self._private_key.get_verifying_key()
-        return (ADDRESS_MAGIC_BYTE + ecdsa_public_key.to_string()).hex()
+        return ADDRESS_MAGIC_BYTE.hex() + self.public_key
 
-    def sign(self, data):
+    def sign(self, data, deterministic=False):
         """
         Sign something
+        :param data: <bytes> or <str>
+        :param deterministic: derive the nonce from the key and the data
+                              (RFC 6979), so the same data always gets the
+                              same signature
         :return:
         """
-        return self._private_key.sign(data.encode()).hex()
+        if deterministic:
+            return self._private_key.sign_deterministic(
+                _as_bytes(data)).hex()
+        return self._private_key.sign(_as_bytes(data)).hex()
 
     def verify(self, data, signature):
         """
@@ -64,10 +135,34 @@ class Key(object):
         :return:
         """
         verify_key = self._private_key.get_verifying_key()
-        return verify_key.verify(binascii.unhexlify(signature), data.encode())
+        return verify_key.verify(binascii.unhexlify(signature),
+                                 _as_bytes(data))
 
     @staticmethod
     def verify_by_public_key(data, signature, public_key):
-        vk = ecdsa.VerifyingKey.from_string(
-            binascii.unhexlify(public_key), Key._curve, Key._hash_function)
-        return vk.verify(binascii.unhexlify(signature), data.encode())
+        """
+        Verify with someone else's public key
+        :return: <Bool> False for a bad signature, or a malformed signature
+                 or key
+        """
+        try:
+            vk = _verifying_key(public_key)
+            return vk.verify(binascii.unhexlify(signature), _as_bytes(data))
+        except (ecdsa.BadSignatureError, MalformedPointError, binascii.Error,
+                TypeError):
+            return False
+
+    @staticmethod
+    def verify_batch(items, workers=None):
+        """
+        Verify many signatures at once, spread over a process pool
+        :param items: <list> of (data, signature, public_key)
+        :param workers: number of processes, one per core by default
+        :return: <list> of <Bool>, in the order of items
+        """
+        workers = workers or multiprocessing.cpu_count()
+        if workers == 1 or len(items) < BATCH_MIN_SIZE:
+            return [_verify_item(item) for item in items]
+        chunksize = max(1, len(items) // (workers * 4))
+        return list(_get_verify_pool(workers).map(_verify_item, items,
+                                                  chunksize=chunksize))
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+from blockchain.block import BlockHeader
+from blockchain.codec import U32
+
+
+class Mempool(object):
+    """
+    The transactions waiting for a block, by txid and oldest first. Bounded
+    in count and in bytes: the oldest go first when it is full, and any older
+    than max_age expire.
+    """
+
+    def __init__(self, max_count=10000, max_bytes=16 << 20, max_age=3600):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        #: txid -> (transaction, encoded size, time added)
+        self._trxs = OrderedDict()
+        self.bytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._trxs)
+
+    def __contains__(self, txid):
+        return txid in self._trxs
+
+    def __iter__(self):
+        with self._lock:
+            return iter([trx for trx, _, _ in self._trxs.values()])
+
+    def get(self, txid):
+        """
+        :return: <Transaction> None if it is not in the pool
+        """
+        entry = self._trxs.get(txid)
+        return entry[0] if entry else None
+
+    def add(self, trx):
+        """
+        :return: <Bool> False if it is in already
+        """
+        with self._lock:
+            txid = trx.txid
+            if txid in self._trxs:
+                return False
+            size = len(trx.encode(True))
+            self._trxs[txid] = (trx, size, time.time())
+            self.bytes += size
+            self.expire()
+            while len(self._trxs) > self.max_count or \
+                    self.bytes > self.max_bytes:
+                self._pop_oldest()
+            return txid in self._trxs
+
+    def _pop_oldest(self):
+        _, (_, size, _) = self._trxs.popitem(last=False)
+        self.bytes -= size
+
+    def expire(self, now=None):
+        """
+        Drop the transactions older than max_age
+        """
+        deadline = (now or time.time()) - self.max_age
+        with self._lock:
+            while self._trxs and \
+                    next(iter(self._trxs.values()))[2] < deadline:
+                self._pop_oldest()
+
+    def remove(self, txids):
+        with self._lock:
+            for txid in txids:
+                entry = self._trxs.pop(txid, None)
+                if entry:
+                    self.bytes -= entry[1]
+
+    def remove_block(self, block):
+        """
+        Drop the transactions the block includes
+        """
+        self.remove([trx.txid for trx in block.transactions])
+
+    def template(self, max_bytes):
+        """
+        The transactions for a new block, oldest first, as many as fit in
+        max_bytes of encoded block
+        :return: <list>
+        """
+        trxs, budget = [], max_bytes - BlockHeader.SIZE - U32.size
+        with self._lock:
+            for trx, size, _ in self._trxs.values():
+                if size + U32.size <= budget:
+                    trxs.append(trx)
+                    budget -= size + U32.size
+        return trxs
@@ -0,0 +1,199 @@
+"""
+Counters, gauges and histograms of the node, served at /metrics in the
+Prometheus text exposition format. Rates, e.g. hashes/s, are left to the
+scraper: it divides the growth of a counter by the time between two scrapes.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+#: every metric, in the order they are exposed
+registry = []
+
+#: seconds, from a fast signature check to a slow sync page
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                   2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', r'\\').replace('"', r'\"')) for name, value in pairs)
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(object):
+    """
+    A named family of values, one per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        if not self.labels:
+            #: exposed before the first update
+            self._values[()] = self._zero()
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _zero(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('%s takes the labels %s' % (self.name,
+                                                         self.labels))
+        return tuple(labels[name] for name in self.labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """
+        :return: <list> of (name, label string, value)
+        """
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend('%s%s %s' % (name, labels, _format_value(value))
+                     for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        super(Gauge, self).__init__(name, description, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """
+        Read the value from function at every scrape
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function:
+            return [(self.name, '', self._function())]
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    """
+    Observations counted in cumulative buckets, with their sum and count
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, description, labels)
+
+    def _zero(self):
+        #: [count per bucket..., count above the last bucket, sum]
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = self._zero()
+            entry[bisect.bisect_left(self.buckets, value)] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_t, **labels)
+
+    def get(self, **labels):
+        """
+        :return: <Integer> the number of observations
+        """
+        entry = self._values.get(self._key(labels))
+        return sum(entry[:-1]) if entry else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                count = 0
+                for bound, hits in zip(self.buckets + ('+Inf',), entry):
+                    count += hits
+                    samples.append((self.name + '_bucket', _format_labels(
+                        self.labels, key, [('le', bound)]), count))
+                labels = _format_labels(self.labels, key)
+                samples.append((self.name + '_sum', labels, entry[-1]))
+                samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+def expose():
+    """
+    :return: <str> every metric in the text exposition format
+    """
+    return '\n'.join(metric.expose() for metric in registry) + '\n'
+
+
+mining_hashes = Counter('pok_mining_hashes_total', 'Nonces tried')
+mining_hashrate = Gauge('pok_mining_hashrate',
+                        'Hashes per second of the last search')
+blocks_found = Counter('pok_blocks_found_total',
+                       'Blocks mined by this node and accepted')
+signatures_verified = Counter('pok_signatures_verified_total',
+                              'Signatures checked, cache misses only')
+signature_cache_hits = Counter('pok_signature_cache_hits_total',
+                               'Signatures found verified in the cache')
+signature_verify_seconds = Histogram(
+    'pok_signature_verify_seconds',
+    'Time to check the signatures missing from the cache, per batch')
+request_seconds = Histogram('pok_http_request_seconds',
+                            'Time to serve a request', ('handler', 'method'))
+broadcast_seconds = Histogram(
+    'pok_broadcast_seconds',
+    'Time from queueing a message for a peer to its delivery')
+broadcast_dropped = Counter('pok_broadcast_dropped_total',
+                            'Messages to peers dropped or given up on')
+compact_blocks = Counter('pok_compact_blocks_total',
+                         'Compact blocks received, by how they got completed',
+                         ('result',))
+compact_missing = Counter(
+    'pok_compact_missing_transactions_total',
+    'Transactions of compact blocks missing from the mempool')
+mempool_transactions = Gauge('pok_mempool_transactions',
+                             'Transactions waiting for a block')
+mempool_bytes = Gauge('pok_mempool_bytes',
+                      'Encoded size of the transactions in the mempool')
+chain_height = Gauge('pok_chain_height', 'Blocks in the chain')
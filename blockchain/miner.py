@@ -0,0 +1,261 @@
+import logging
+import multiprocessing
+import threading
+import time
+import _sha256
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait
+
+from tornado.ioloop import IOLoop
+
+from blockchain import metrics
+from blockchain.block import Block, BlockHeader
+
+#: nonces handed out to a worker at a time
+CHUNK_SIZE = 20000
+#: how often (in nonces) a worker checks whether it should give up
+CHECK_INTERVAL = 500
+
+#: the stop flag, inherited by every worker process
+_stop_event = None
+
+
+def _init_worker(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+
+
+def search(header, start, stop, difficulty, stop_event=None):
+    """
+    Walk the nonces in [start, stop) looking for a proof of work. The
+    header without the nonce is hashed once, every attempt only copies that
+    midstate and feeds the nonce.
+    :param header: <BlockHeader> the template
+    :param stop_event: checked every CHECK_INTERVAL nonces
+    :return: <Integer> the winning nonce or None
+    """
+    stop_event = stop_event or _stop_event
+    midstate = _sha256.sha256(header.prefix())
+    nonce_bytes, target = BlockHeader.nonce_bytes, '0' * difficulty
+    for nonce in range(start, stop):
+        if nonce % CHECK_INTERVAL == 0 and stop_event is not None \
+                and stop_event.is_set():
+            return None
+        attempt = midstate.copy()
+        attempt.update(nonce_bytes(nonce))
+        if attempt.hexdigest().startswith(target):
+            return nonce
+    return None
+
+
+class Miner(object):
+    """
+    Searches the nonce space in parallel. Every worker gets its own disjoint
+    range of CHUNK_SIZE nonces; the first winning nonce stops all the others.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self._stop = multiprocessing.Event()
+        self._pool = None
+        #: bumped by every cancel, a search for an older one is stale
+        self.generation = 0
+
+    def _get_pool(self):
+        if not self._pool:
+            self._pool = ProcessPoolExecutor(self.workers,
+                                             initializer=_init_worker,
+                                             initargs=(self._stop,))
+        return self._pool
+
+    def cancel(self):
+        """
+        Abandon the running search, e.g. a peer's block arrived first
+        """
+        self.generation += 1
+        self._stop.set()
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def mine(self, block, difficulty, attempts=None, generation=None):
+        """
+        Find a nonce for the block
+        :param attempts: give up after that many nonces, None to never give up
+        :param generation: the one the block was made in, the search is
+                           skipped if cancelled since
+        :return: <Block> the block with a valid nonce, None if cancelled or
+                 attempts were exhausted
+        """
+        self._stop.clear()
+        #: after clearing, a cancel racing with it shows in either
+        if generation is not None and generation != self.generation:
+            return None
+        end = block.nonce + attempts if attempts is not None else None
+        start_t, first = time.perf_counter(), block.nonce
+        if self.workers == 1:
+            # no pool to pay for
+            nonce, start = None, block.nonce
+            while nonce is None and (end is None or start < end):
+                stop = min(start + CHUNK_SIZE, end or start + CHUNK_SIZE)
+                nonce = search(block.header, start, stop, difficulty,
+                               self._stop)
+                start = stop
+                if self._stop.is_set():
+                    nonce = None
+                    break
+            #: a chunk cut short by the stop flag counts in full
+            hashes = (start if nonce is None else nonce + 1) - first
+        else:
+            nonce, hashes = self._mine_parallel(block, difficulty, end)
+        self._count(hashes, time.perf_counter() - start_t)
+        if nonce is None:
+            return None
+        block.nonce = nonce
+        return block
+
+    @staticmethod
+    def _count(hashes, elapsed):
+        metrics.mining_hashes.inc(hashes)
+        if elapsed:
+            metrics.mining_hashrate.set(hashes / elapsed)
+
+    def _mine_parallel(self, block, difficulty, end):
+        """
+        :return: (winning nonce or None, nonces searched)
+        """
+        pool, pending, start = self._get_pool(), set(), block.nonce
+        #: future -> the size of its chunk
+        chunks = {}
+
+        def submit():
+            nonlocal start
+            if end is not None and start >= end:
+                return
+            stop = min(start + CHUNK_SIZE, end or start + CHUNK_SIZE)
+            #: only the header travels to the workers
+            future = pool.submit(search, block.header, start, stop,
+                                 difficulty)
+            chunks[future] = stop - start
+            pending.add(future)
+            start = stop
+
+        # keep every worker busy with one queued chunk in reserve
+        for _ in range(self.workers * 2):
+            submit()
+        nonce = None
+        while pending and nonce is None and not self._stop.is_set():
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winners = [f.result() for f in done if f.result() is not None]
+            if winners:
+                nonce = min(winners)
+                break
+            for _ in done:
+                submit()
+        #: stop the rest and let the running chunks drain
+        self._stop.set()
+        for future in pending:
+            future.cancel()
+        wait(pending)
+        if nonce is None:
+            logging.debug("mining cancelled at nonce %d", start)
+        #: as above, chunks cut short count in full
+        hashes = sum(size for future, size in chunks.items()
+                     if not future.cancelled())
+        return nonce, hashes
+
+
+class MiningWorker(threading.Thread):
+    """
+    Mines in the background so the IOLoop never runs a proof of work. The
+    template is rebuilt from the node whenever its tip or mempool changes and
+    found blocks are handed back to the IOLoop. Only the nonce search runs on
+    this thread, the template is built on the IOLoop, which owns the chain,
+    the state and the store.
+    """
+
+    def __init__(self, node, on_block=None, loop=None):
+        """
+        :param on_block: called on the IOLoop with every block found and
+                         accepted by the node
+        """
+        super(MiningWorker, self).__init__(daemon=True)
+        self.node = node
+        self.on_block = on_block
+        self.loop = loop or IOLoop.current()
+        #: the block being mined
+        self.template = None
+        self.found = 0
+        self._wake = threading.Event()
+        #: have a look as soon as started
+        self._wake.set()
+        self._stopped = False
+        #: <Future> of the template being built on the IOLoop
+        self._pending = None
+
+    def wake(self):
+        """
+        Look for something (new) to mine
+        """
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self.node.miner.cancel()
+        self._wake.set()
+        if self._pending:
+            self._pending.cancel()
+
+    def status(self):
+        template = self.template
+        return {
+            'mining': template is not None,
+            'height': template.index if template else None,
+            'transactions': len(template.transactions) if template else 0,
+            'found': self.found,
+        }
+
+    def run(self):
+        while not self._stopped:
+            self._wake.wait()
+            self._wake.clear()
+            self._pending = Future()
+            self.loop.add_callback(self._build, self._pending)
+            try:
+                template, generation = self._pending.result()
+            except CancelledError:
+                break
+            except Exception:
+                logging.exception('failed to build a block template')
+                continue
+            if not template:
+                continue
+            self.template = template
+            block = self.node.miner.mine(template, Block.difficulty,
+                                         generation=generation)
+            self.template = None
+            if block:
+                self.loop.add_callback(self._publish, block)
+
+    def _build(self, future):
+        """
+        The template and the generation of the miner it belongs to, on the
+        IOLoop
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result((self.node.block_template(),
+                               self.node.miner.generation))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _publish(self, block):
+        if self.node.add_block(block):
+            self.found += 1
+            metrics.blocks_found.inc()
+            logging.info("mined new block: %s", block.index)
+            if self.on_block:
+                self.on_block(block)
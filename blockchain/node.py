@@ -1,6 +1,10 @@
 from blockchain.block import Block
 from blockchain.chain import Chain
+from blockchain.mempool import Mempool
+from blockchain.miner import Miner
+from blockchain.state import State
 
+import os
 import time
 import logging
 
@@ -13,58 +17,162 @@ class Node(object):
     """
 
     TRX_PER_BLOCK = 2
+    #: most bytes of an encoded block
+    MAX_BLOCK_BYTES = 1 << 20
 
-    def __init__(self):
-        self.transactions = []
-        self.chain = Chain()
+    def __init__(self, workers=1, checkpoints=None, store=None,
+                 mempool=None, allocations=None):
+        """
+        :param store: <BlockStore> to keep the chain in, in memory if None.
+                      The snapshots of the state go next to it
+        :param allocations: {address: balance} before the genesis block
+        """
+        self.mempool = mempool or Mempool()
+        #: <MiningWorker> mining in the background, if any
+        self.worker = None
+        self.state = State(allocations, os.path.join(store.path, 'state.json')
+                           if store is not None else None)
+        self.chain = Chain(store, checkpoints, validated=store is not None,
+                           state=self.state)
+        self.miner = Miner(workers)
 
     def init(self, blocks=None):
         """
-        Sync blocks from other nodes or mine the genesis block
+        Sync blocks from other nodes or mine the genesis block, unless the
+        chain was loaded from its store
         """
         if blocks:
-            for b in blocks:
-                self.chain.add_block(b)
-        else:
-            block = self.mine_block(0, 0, [])
+            #: validated in one go, skipping what a checkpoint vouches for
+            if not self.chain.extend(blocks):
+                logging.warning('the blocks to init with are invalid')
+        elif not self.chain.height:
+            block = self.mine_block(0, 0, [], self.miner)
             self.chain.add_block(block)
 
-    def add_block(self, doc):
-        block = Block.from_json(doc)
-        if block.index == self.chain.height:
-            self.chain.add_block(block)
+    def add_block(self, block):
+        """
+        A block from a peer, extending the chain or one of its side branches
+        :return: <Bool> whether it is on the chain now
+        """
+        accepted = self.chain.accept(block)
+        if not accepted or not accepted[1]:
+            return False
+        #: someone else won this height
+        self._reorganized(*accepted)
+        return True
+
+    def _reorganized(self, disconnected, connected):
+        """
+        The transactions of the connected blocks leave the mempool, the ones
+        of the disconnected blocks return. The ones the state does not admit
+        anymore, e.g. on the new blocks too or spent by them, are dropped
+        """
+        for block in connected:
+            self.mempool.remove_block(block)
+        for block in disconnected:
+            for trx in block.transactions:
+                if self.state.admits(trx):
+                    self.mempool.add(trx)
+        self.mempool.remove([trx.txid for trx in self.mempool
+                             if not self.state.admits(trx)])
+        self._changed()
+
+    def _changed(self):
+        """
+        The tip or the mempool changed, the block being mined is stale
+        """
+        self.miner.cancel()
+        if self.worker:
+            self.worker.wake()
+
+    def switch(self, fork, blocks):
+        """
+        Switch to a fork of the chain
+        :return: <Bool> whether it was switched
+        """
+        disconnected = self.chain.switch(fork, blocks)
+        if disconnected is None:
+            return False
+        self._reorganized(disconnected, blocks)
+        return True
+
+    def extend(self, blocks, vouched=None):
+        """
+        Blocks extending the chain, e.g. synced
+        :param vouched: see Chain.extend
+        :return: <Bool> whether they were all appended
+        """
+        if not self.chain.extend(blocks, vouched):
+            return False
+        self._reorganized([], blocks)
+        return True
 
     def add_transaction(self, transaction):
         """
         A new transaction to be included in next block
+        :return: <Bool> whether it was new and valid
+        """
+        #: one on the chain already used its nonce, the state turns it away
+        if transaction.txid in self.mempool or \
+                not self.state.admits(transaction):
+            return False
+        if not (transaction.is_valid() and self.mempool.add(transaction)):
+            return False
+        self._changed()
+        return True
+
+    def next_nonce(self, address):
+        """
+        The nonce of the next transaction of the address, after the ones in
+        the mempool
+        """
+        nonce = self.state.nonce(address)
+        for trx in self.mempool:
+            if trx.sender == address:
+                nonce = max(nonce, trx.nonce + 1)
+        return nonce
+
+    def block_template(self):
+        """
+        The next block to mine, from the mempool
+        :return: <Block> None if there are not enough transactions
         """
-        if transaction.is_valid():
-            self.transactions.append(transaction)
+        if len(self.mempool) <= self.TRX_PER_BLOCK:
+            return None
+        trxs = self.state.select(self.mempool.template(self.MAX_BLOCK_BYTES))
+        if len(trxs) <= self.TRX_PER_BLOCK:
+            #: the others wait for the ones of their senders before them
+            return None
+        return Block(self.chain.height, self.chain.last_block.hash, trxs)
 
     def mine(self):
-        if len(self.transactions) > self.TRX_PER_BLOCK:
+        """
+        Mine a block in the foreground
+        :return: <Block> None if there was nothing to mine
+        """
+        block = self.block_template()
+        if block:
             logging.info("mining new block")
-            block = Node.mine_block(self.chain.height,
-                                    self.chain.last_block.hash,
-                                    self.transactions)
-            self.chain.add_block(block)
-            #: clear
-            self.transactions = []
-            return block
+            if self.miner.mine(block, Block.difficulty) and \
+                    self.chain.add_block(block):
+                self.mempool.remove_block(block)
+                return block
         return None
 
     @staticmethod
-    def mine_block(index, prev_hash, transactions):
+    def mine_block(index, prev_hash, transactions, miner=None,
+                   timestamp=None):
         """
         Create new block with current transactions
+        :param miner: <Miner> searches the nonces, in-process if not given
+        :param timestamp: of the block, now if not given
+        :return: <Block> None if the miner got cancelled
         """
         start_t = time.time()
-        block = Block(index, prev_hash, transactions)
-        while True:
-            if block.is_valid():
-                logging.debug("Aha. Mined a valid block %s with nonce %s, "
-                              "time: %d", block.hash, block.nonce,
-                              time.time() - start_t)
-                return block
-            logging.debug("Mining, %d", block.nonce)
-            block.increase_nonce()
+        block = Block(index, prev_hash, transactions, timestamp=timestamp)
+        block = (miner or Miner(1)).mine(block, Block.difficulty)
+        if block:
+            logging.debug("Aha. Mined a valid block %s with nonce %s, "
+                          "time: %d", block.hash, block.nonce,
+                          time.time() - start_t)
+        return block
@@ -0,0 +1,85 @@
+"""
+A sampling profiler for the running node. A thread snapshots the stack of
+every other thread at a fixed interval and counts them in the collapsed
+format, `outer;inner;innermost count` per line, which flamegraph.pl and
+speedscope read as is. Nothing is traced between samples, so it can be left
+running under load.
+"""
+import os
+import sys
+import threading
+from collections import Counter
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class Profiler(object):
+    """
+    Samples the stacks of the process while running
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        #: collapsed stack -> samples
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        """
+        Start sampling afresh, the previous samples are dropped
+        """
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            sampled = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                #: the thread is the root of its stacks
+                stack.append(names.get(ident, 'thread-%d' % ident))
+                sampled.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+    def collapsed(self):
+        """
+        :return: <str> one `stack count` line per distinct stack
+        """
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
@@ -1,22 +1,54 @@
 import tornado.ioloop
-import requests
 import tornado.web
-import random
-import logging
+from ecdsa.errors import MalformedPointError
 import argparse
+import gzip
 import json
+import multiprocessing
+import struct
 
 import sys
 sys.path.insert(0, '../')
 
+from blockchain import metrics
 from blockchain.node import Node
 from blockchain.block import Block
+from blockchain.broadcast import Broadcaster
+from blockchain.cache import LRUCache
+from blockchain.chain import MAX_FORK_DEPTH
+from blockchain.codec import BINARY, CodecError, U32, pack_bytes
+from blockchain.gossip import Gossip
 from blockchain.key import Key
+from blockchain.miner import MiningWorker
+from blockchain.profiler import Profiler
+from blockchain.store import BlockStore, PrunedError
+from blockchain.sync import Syncer
 from blockchain.transaction import Transaction
 
-node = Node()
-node.init()
+node = None
 peers = []
+broadcaster = Broadcaster(peers)
+gossip = None
+worker = None
+#: <Profiler> behind /profile/, only with --profile
+profiler = None
+#: most blocks and headers served per request
+MAX_BLOCKS = 500
+MAX_HEADERS = 2000
+#: transactions verified and answered for at a time by /transactions/
+BATCH_SIZE = 256
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+#: encoded blocks by (hash, binary)
+block_bytes = LRUCache(4096)
+#: pages of /block/ by ETag, (body, gzipped body or None)
+pages = LRUCache(64)
+
+
+metrics.mempool_transactions.set_function(lambda: len(node.mempool)
+                                          if node else 0)
+metrics.mempool_bytes.set_function(lambda: node.mempool.bytes if node else 0)
+metrics.chain_height.set_function(lambda: node.chain.height if node else 0)
 
 
 class ComplexEncoder(json.JSONEncoder):
@@ -32,43 +64,161 @@ def ok(data=None):
     return json.dumps({'code': 0, 'data': data or {}}, cls=ComplexEncoder)
 
 
-def broadcast_block(doc):
-    ttl = doc.get('ttl', 1)
-    if ttl == 0:
-        return
-    doc['ttl'] = ttl - 1
-    for peer in peers:
-        if random.randrange(1, 20) > 10:
-            #: network failure
-            continue
-        logging.info("broadcasting block: %s to peer %s", doc['index'], peer)
-        requests.post(peer+"/block/", json=doc)
-
-
-def broadcast_trx(doc):
-    ttl = doc.get('ttl', 1)
-    if ttl == 0:
-        return
-    doc['ttl'] = 0
-    for peer in peers:
-        #: network failure
-        if random.randrange(1, 20) > 13:
-            continue
-        logging.info("broadcasting transaction: %s to peer %s", doc['payload'],
-                     peer)
-        requests.post(peer + "/transaction/", json=doc)
+def is_binary(request):
+    """
+    Peers talk in the binary encoding, JSON is for the API
+    """
+    return request.headers.get('Content-Type') == BINARY
+
+
+def int_argument(handler, name, default):
+    """
+    :return: <Integer> the query argument, 400 if it is not one
+    """
+    value = handler.get_argument(name, default)
+    try:
+        return int(value)
+    except ValueError:
+        raise tornado.web.HTTPError(400, '%s is not an integer: %r',
+                                    name, value)
+
+
+def broadcast_block(block):
+    if gossip:
+        gossip.announce_block(block)
+
+
+def broadcast_trx(trx):
+    if gossip:
+        gossip.announce_transaction(trx)
+
+
+def pruned(e):
+    """
+    The error for a block whose body the node pruned, gone for good
+    """
+    return tornado.web.HTTPError(410, reason=str(e))
+
+
+def find_transaction(txid):
+    """
+    :return: (height, position) of the transaction
+    :raise HTTPError: 404 if unknown, 410 if it may be in a pruned body
+    """
+    found = node.chain.find_transaction(txid)
+    if found:
+        return found
+    if node.chain.pruned_height:
+        raise pruned('unknown transaction, blocks below %d are pruned' %
+                     node.chain.pruned_height)
+    raise tornado.web.HTTPError(404)
+
+
+def encode_block(block, binary):
+    """
+    The block as served, cached: blocks never change, a reorg only changes
+    which of them are served
+    :return: <bytes> length prefixed binary encoding, or JSON
+    """
+    key = (block.hash, binary)
+    data = block_bytes.get(key)
+    if data is None:
+        data = pack_bytes(block.encode()) if binary else \
+            json.dumps(block.json()).encode()
+        block_bytes.put(key, data)
+    return data
 
 
 class BlockHandler(tornado.web.RequestHandler):
     def get(self):
-        self.write(ok(node.chain.blocks))
+        """
+        The blocks from start on, at most limit of them, the next page is
+        linked to. Peers ask for the binary encoding. The last block of the
+        page fixes all of it, so its hash makes the ETag, and the pages served
+        lately are kept encoded and gzipped.
+        """
+        binary = self.request.headers.get('Accept') == BINARY
+        start = max(int_argument(self, 'start', 0), 0)
+        limit = min(max(int_argument(self, 'limit', MAX_BLOCKS), 1),
+                    MAX_BLOCKS)
+        height = node.chain.height
+        stop = min(start + limit, height)
+        self.set_header('Content-Type', BINARY if binary else JSON)
+        if stop < height:
+            self.set_header('Link', '<%s?start=%d&limit=%d>; rel="next"' % (
+                self.request.path, stop, limit))
+        if start >= stop:
+            self.write(b'' if binary else ok([]))
+            return
+        if start < node.chain.pruned_height:
+            raise pruned('blocks below %d are pruned' %
+                         node.chain.pruned_height)
+        etag = '"%s-%d-%s"' % (node.chain.blocks[stop - 1].hash, start,
+                               'binary' if binary else 'json')
+        self.set_header('Etag', etag)
+        #: Accept-Encoding gets added by the application's gzip
+        self.set_header('Vary', 'Accept')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        page = pages.get(etag)
+        if page is None:
+            parts = [encode_block(block, binary)
+                     for block in node.chain.blocks[start:stop]]
+            body = b''.join(parts) if binary else \
+                b'{"code": 0, "data": [' + b', '.join(parts) + b']}'
+            compressed = gzip.compress(body)
+            page = (body, compressed if len(compressed) < len(body) else None)
+            pages.put(etag, page)
+        body, compressed = page
+        if compressed and 'gzip' in self.request.headers.get(
+                'Accept-Encoding', ''):
+            #: the application's gzip leaves it alone
+            self.set_header('Content-Encoding', 'gzip')
+            body = compressed
+        self.write(body)
 
     def post(self):
-        doc = json.loads(self.request.body)
-        node.add_block(doc)
-        #: broadcast the new block
+        if is_binary(self.request):
+            block = Block.decode(self.request.body)
+        else:
+            block = Block.from_json(json.loads(self.request.body))
+        #: only announce blocks new to us, and valid
+        if node.add_block(block):
+            broadcast_block(block)
         self.finish(ok())
-        broadcast_block(doc)
+
+
+class BlockByHashHandler(tornado.web.RequestHandler):
+    def get(self, block_hash):
+        try:
+            block = node.chain.block_by_hash(block_hash)
+        except PrunedError as e:
+            raise pruned(e)
+        if not block:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', JSON)
+        #: the hash is the ETag, what it names never changes
+        self.set_header('Etag', '"%s"' % block_hash)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(b'{"code": 0, "data": ' + encode_block(block, False) +
+                   b'}')
+
+
+class HeadersHandler(tornado.web.RequestHandler):
+    def get(self):
+        """
+        The headers following the first block of the locator we have, binary
+        """
+        locator = [h for h in self.get_argument('locator', '').split(',') if h]
+        limit = min(int_argument(self, 'limit', MAX_HEADERS), MAX_HEADERS)
+        start = node.chain.locate(locator)
+        stop = min(start + limit, node.chain.height)
+        self.set_header('Content-Type', BINARY)
+        self.write(b''.join(node.chain.header(height).encode()
+                            for height in range(start, stop)))
 
 
 class HeightHandler(tornado.web.RequestHandler):
@@ -77,54 +227,226 @@ class HeightHandler(tornado.web.RequestHandler):
 
 
 class TransactionHandler(tornado.web.RequestHandler):
-    def post(self):
+    def _parse(self):
+        if is_binary(self.request):
+            #: signed already, e.g. by a wallet
+            return Transaction.decode(self.request.body)
         doc = json.loads(self.request.body)
-        trx = Transaction(doc['sender_addr'], doc['sender_public'],
-                          doc['recipient_addr'], doc['payload'])
+        sender = doc['sender_addr']
+        trx = Transaction(sender, doc['sender_public'],
+                          doc['recipient_addr'], doc['payload'],
+                          amount=doc.get('amount', 0),
+                          nonce=doc.get('nonce', node.next_nonce(sender)))
         trx.sign(doc['sender_private'])
-        #: broadcast the new transaction
-        broadcast_trx(doc)
-        new_block = node.add_transaction(trx)
-        #: broadcast new blocks
+        return trx
+
+    def post(self):
+        try:
+            trx = self._parse()
+            #: encodes every field, e.g. hex keys and the amount as U64
+            trx.txid
+        except (CodecError, ValueError, TypeError, KeyError, AttributeError,
+                struct.error, MalformedPointError) as e:
+            raise tornado.web.HTTPError(400, 'malformed transaction: %s', e)
+        #: only announce transactions new to us, and valid
+        if node.add_transaction(trx):
+            broadcast_trx(trx)
         self.finish(ok())
-        if new_block:
-            logging.info("mined new block: %s", new_block.index)
-            broadcast_block(new_block.json())
+
+
+@tornado.web.stream_request_body
+class TransactionBatchHandler(tornado.web.RequestHandler):
+    """
+    Signed transactions in bulk, one JSON document per line or, with the
+    binary content type, length prefixed encodings. They are parsed as the
+    body arrives, then verified in parallel batches; a result line per
+    transaction is streamed back after every batch.
+    """
+
+    def prepare(self):
+        self.binary = is_binary(self.request)
+        self.buffer = bytearray()
+        #: <Transaction> per frame, None for a malformed one
+        self.transactions = []
+
+    def data_received(self, chunk):
+        self.buffer += chunk
+        self._parse_frames()
+
+    def _parse_frames(self, final=False):
+        pos = 0
+        while True:
+            if self.binary:
+                if len(self.buffer) - pos < U32.size:
+                    break
+                end = pos + U32.size + U32.unpack_from(self.buffer, pos)[0]
+                if end > len(self.buffer):
+                    break
+                frame = bytes(self.buffer[pos + U32.size:end])
+            else:
+                end = self.buffer.find(b'\n', pos)
+                if end < 0:
+                    break
+                frame, end = bytes(self.buffer[pos:end]), end + 1
+                if not frame.strip():
+                    pos = end
+                    continue
+            self.transactions.append(self._parse(frame))
+            pos = end
+        del self.buffer[:pos]
+        if final and self.buffer.strip():
+            #: the last line needs no newline, a cut binary frame is broken
+            self.transactions.append(
+                None if self.binary else self._parse(bytes(self.buffer)))
+
+    def _parse(self, frame):
+        try:
+            if self.binary:
+                return Transaction.decode(frame)
+            trx = Transaction.from_json(json.loads(frame))
+            #: encodes every field, e.g. hex keys and the amount as U64
+            trx.txid
+            return trx
+        except (CodecError, ValueError, TypeError, KeyError, struct.error):
+            return None
+
+    async def post(self):
+        self._parse_frames(final=True)
+        self.set_header('Content-Type', NDJSON)
+        loop = tornado.ioloop.IOLoop.current()
+        for start in range(0, len(self.transactions), BATCH_SIZE):
+            batch = self.transactions[start:start + BATCH_SIZE]
+            #: off the IOLoop, add_transaction then only hits the cache
+            verdicts = iter(await loop.run_in_executor(
+                None, Transaction.verify_batch, [t for t in batch if t]))
+            for idx, trx in enumerate(batch, start):
+                result = {'index': idx, 'txid': trx and trx.txid,
+                          'accepted': False}
+                if trx is None:
+                    result['error'] = 'malformed'
+                elif not next(verdicts):
+                    result['error'] = 'invalid'
+                elif not node.add_transaction(trx):
+                    #: known already, or no room in the mempool
+                    result['error'] = 'rejected'
+                else:
+                    result['accepted'] = True
+                    broadcast_trx(trx)
+                self.write(json.dumps(result) + '\n')
+            await self.flush()
+
+
+class TransactionLookupHandler(tornado.web.RequestHandler):
+    def get(self, txid):
+        height, pos = find_transaction(txid)
+        trx = node.chain.blocks[height].transactions[pos]
+        self.write(ok({'height': height, 'position': pos,
+                       'transaction': trx.json(with_sign=True)}))
+
+
+class ProofHandler(tornado.web.RequestHandler):
+    def get(self, txid):
+        """
+        The merkle audit path of a transaction, for light clients
+        """
+        height, pos = find_transaction(txid)
+        block = node.chain.blocks[height]
+        self.write(ok({'height': height, 'block': block.hash,
+                       'header': block.header.json(), 'position': pos,
+                       'path': block.proof(pos)}))
+
+
+class AddressHandler(tornado.web.RequestHandler):
+    def get(self, address):
+        """
+        On a pruned node, only the txids of the bodies kept, from the
+        pruned height given along
+        """
+        txids = node.chain.transactions_of(address)
+        if not node.chain.pruned_height:
+            self.write(ok(txids))
+            return
+        self.write(json.dumps({'code': 0, 'data': txids,
+                               'pruned_height': node.chain.pruned_height}))
+
+
+class BalanceHandler(tornado.web.RequestHandler):
+    def get(self, address):
+        self.write(ok({'balance': node.state.balance(address),
+                       'nonce': node.state.nonce(address)}))
 
 
 class ConsensusHandler(tornado.web.RequestHandler):
-    def post(self):
-        #: find the longest chain
-        max_height, target_peer = 0, None
-        for peer in peers:
-            res = requests.get(peer + "/chain/height/")
-            height = int(res.json()['data'])
-            if height > max_height:
-                max_height, target_peer = height, peer
-        #: fetch the blocks from target peer
-        if max_height > node.chain.height:
-            logging.info('found longer chain %d. replace mine %d', max_height,
-                         node.chain.height)
-            res = requests.get(target_peer + '/block/')
-            block_docs = res.json()['data']
-            node.chain.blocks = [Block.from_json(doc) for doc in block_docs]
+    async def post(self):
+        #: catch up with the longest chain
+        await Syncer(node, peers).sync()
         self.write(ok())
 
 
 class MineHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(ok(worker.status()))
+
     def post(self):
-        node.mine()
-        self.write(ok())
+        #: the worker mines in the background, this only nudges it
+        worker.wake()
+        self.write(ok(worker.status()))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.expose())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    def get(self):
+        """
+        The stacks sampled so far, collapsed
+        """
+        self.set_header('Content-Type', 'text/plain')
+        self.write(profiler.collapsed())
+
+    def post(self):
+        """
+        `?enable=1` starts sampling afresh, `?enable=0` stops it
+        """
+        if self.get_argument('enable', '1') == '1':
+            profiler.start()
+        else:
+            profiler.stop()
+        self.write(ok({'running': profiler.running,
+                       'samples': profiler.samples}))
+
+
+class Application(tornado.web.Application):
+    def log_request(self, handler):
+        super(Application, self).log_request(handler)
+        metrics.request_seconds.observe(handler.request.request_time(),
+                                        handler=type(handler).__name__,
+                                        method=handler.request.method)
 
 
 def make_app():
-    return tornado.web.Application([
+    extra = gossip.routes() if gossip else []
+    if profiler:
+        extra.append((r"/profile/", ProfileHandler))
+    #: gzip the other responses on the fly
+    return Application(extra + [
         (r"/block/", BlockHandler),
+        (r"/block/([0-9a-f]{64})/", BlockByHashHandler),
+        (r"/headers/", HeadersHandler),
         (r"/chain/height/", HeightHandler),
         (r"/transaction/", TransactionHandler),
+        (r"/transactions/", TransactionBatchHandler),
+        (r"/transaction/([0-9a-f]{64})/", TransactionLookupHandler),
+        (r"/proof/([0-9a-f]{64})/", ProofHandler),
+        (r"/address/([0-9a-f]+)/", AddressHandler),
+        (r"/balance/([0-9a-f]+)/", BalanceHandler),
         (r"/consensus/", ConsensusHandler),
         (r"/mine/", MineHandler),
-    ])
+        (r"/metrics", MetricsHandler),
+    ], compress_response=True)
 
 
 if __name__ == "__main__":
@@ -134,6 +456,24 @@ if __name__ == "__main__":
     node_parser.set_defaults(which='node')
     node_parser.add_argument('port', type=str)
     node_parser.add_argument('--peers', type=str)
+    node_parser.add_argument('--url', type=str,
+                             help='peers reach this node at, '
+                                  'http://localhost:<port> by default')
+    node_parser.add_argument('--workers', type=int, default=1,
+                             help='mining processes, 0 for one per core')
+    node_parser.add_argument('--datadir', type=str,
+                             help='keep the blocks there across restarts')
+    node_parser.add_argument('--prune', type=int, metavar='N',
+                             help='keep the bodies of the latest N blocks '
+                                  'only, with --datadir')
+    node_parser.add_argument('--checkpoints', type=str,
+                             help='JSON file of trusted block hashes, by '
+                                  'height')
+    node_parser.add_argument('--allocations', type=str,
+                             help='JSON file of the balances, by address, '
+                                  'before the genesis block')
+    node_parser.add_argument('--profile', action='store_true',
+                             help='serve the sampling profiler at /profile/')
 
     key_parser = subparsers.add_parser('key', help='keygen')
     key_parser.set_defaults(which='key')
@@ -142,9 +482,36 @@ if __name__ == "__main__":
     sign_parser.add_argument('private', type=str, help='private key')
 
     args = arger.parse_args()
+    if getattr(args, 'prune', None) is not None:
+        if not args.datadir:
+            arger.error('--prune needs --datadir')
+        if args.prune <= MAX_FORK_DEPTH:
+            arger.error('--prune keeps more than %d blocks' % MAX_FORK_DEPTH)
     if args.which == 'node' and args.port:
         if args.peers:
             peers = [p.strip() for p in args.peers.split(',')]
+        broadcaster = Broadcaster(peers)
+        allocations = None
+        if args.allocations:
+            with open(args.allocations) as f:
+                allocations = json.load(f)
+        checkpoints = None
+        if args.checkpoints:
+            with open(args.checkpoints) as f:
+                checkpoints = {int(height): block_hash
+                               for height, block_hash in json.load(f).items()}
+        node = Node(args.workers or multiprocessing.cpu_count(), checkpoints,
+                    store=args.datadir and BlockStore(args.datadir,
+                                                      keep=args.prune),
+                    allocations=allocations)
+        node.init()
+        if args.profile:
+            profiler = Profiler()
+        gossip = Gossip(node, broadcaster,
+                        args.url or 'http://localhost:%s' % args.port)
+        worker = MiningWorker(node, on_block=broadcast_block)
+        node.worker = worker
+        worker.start()
         app = make_app()
         app.listen(args.port)
         tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,101 @@
+"""
+Simplified payment verification. A light client keeps the block headers only,
+88 bytes a block, and checks that a transaction is in a block with the merkle
+audit path of its txid, O(log n) hashes, instead of downloading the block.
+"""
+import json
+import logging
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient
+
+from blockchain.block import Block, ZERO_HASH
+from blockchain.chain import Chain
+from blockchain.codec import BINARY
+from blockchain.sync import HEADERS_PER_REQUEST, decode_headers
+from merkletree.merkle_tree import MerkleTree
+
+
+def verify_inclusion(txid, path, header):
+    """
+    Whether the audit path leads from the txid to the merkle root the header
+    commits to
+    :param path: [(hash, 'l' or 'r')], see Block.proof
+    :param header: <BlockHeader> trusted, e.g. checked by a LightClient
+    """
+    return MerkleTree.verify_proof(txid, path, header.merkle_root)
+
+
+class LightClient(object):
+    """
+    Follows the headers of the chain of a peer and verifies transactions
+    against them
+    """
+
+    def __init__(self, peer, timeout=10):
+        self.peer = peer
+        self.timeout = timeout
+        #: <BlockHeader> of the chain, linked and with their proof of work
+        self.headers = []
+
+    async def _get(self, path, binary=False):
+        headers = {'Accept': BINARY} if binary else {}
+        res = await AsyncHTTPClient().fetch(self.peer + path, headers=headers,
+                                            request_timeout=self.timeout)
+        return res.body
+
+    def _extend(self, headers):
+        """
+        Switch to headers from their first height on, if they link up to ours
+        and leave more work than we had
+        """
+        fork = headers[0].index
+        if fork > len(self.headers) or \
+                fork + len(headers) <= len(self.headers):
+            return False
+        parent_hash = self.headers[fork-1].hash if fork else ZERO_HASH
+        for idx, header in enumerate(headers):
+            if header.index != fork + idx or \
+                    header.prev_hash != parent_hash or \
+                    not Block.proof_of_work(header, Block.difficulty):
+                return False
+            parent_hash = header.hash
+        del self.headers[fork:]
+        self.headers.extend(headers)
+        return True
+
+    async def sync(self):
+        """
+        Catch up with the headers of the peer
+        :return: <Bool> whether they changed
+        """
+        changed = False
+        while True:
+            query = urlencode({'locator': ','.join(
+                Chain.locator_of(self.headers)), 'limit': HEADERS_PER_REQUEST})
+            batch = decode_headers(await self._get('/headers/?' + query,
+                                                   binary=True))
+            if not batch or not self._extend(batch):
+                return changed
+            changed = True
+            if len(batch) < HEADERS_PER_REQUEST:
+                return changed
+
+    async def verify_transaction(self, txid):
+        """
+        Whether the transaction is in a block of the chain, from its proof
+        :return: <Integer> the height of its block, None if not proven
+        """
+        try:
+            proof = json.loads(await self._get('/proof/%s/' % txid))['data']
+        except Exception as e:
+            logging.warning('failed to get the proof of %s: %s', txid, e)
+            return None
+        height = proof['height']
+        #: only our own headers are trusted
+        if height >= len(self.headers) or \
+                self.headers[height].hash != proof['block'] or \
+                not verify_inclusion(txid, proof['path'],
+                                     self.headers[height]):
+            return None
+        return height
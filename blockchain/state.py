@@ -0,0 +1,225 @@
+"""
+The balance and the nonce of every address at the tip of the chain. They are
+updated as blocks are connected, so checking a transaction is two dict
+lookups instead of a scan of the chain. Connecting a block records the
+previous values of the accounts it touches, undoing it restores them; deeper
+than the undo records go, the state is rebuilt from a snapshot, taken every
+SNAPSHOT_INTERVAL blocks and saved to disk, by replaying the blocks since.
+"""
+import json
+import logging
+import os
+from collections import deque
+
+from blockchain.block import ZERO_HASH
+
+#: blocks that can be disconnected from their undo records
+UNDO_DEPTH = 1000
+#: blocks between two snapshots
+SNAPSHOT_INTERVAL = 1000
+#: snapshots kept in memory, the latest one is on disk as well
+SNAPSHOTS = 4
+
+
+class State(object):
+    """
+    Accounts as of the block at height - 1. Coins are only ever issued by
+    the allocations, the accounts before the genesis block
+    """
+
+    def __init__(self, allocations=None, path=None):
+        """
+        :param allocations: {address: balance} before the genesis block
+        :param path: of the file the latest snapshot goes to, if any
+        """
+        self.allocations = dict(allocations or {})
+        self.path = path
+        #: (hash of the previous block, {address: (balance, nonce)} before
+        #: the block, None for an account it created) per connected block
+        self._undo = deque(maxlen=UNDO_DEPTH)
+        #: (height, block hash, balances, nonces), oldest first
+        self._snapshots = deque(maxlen=SNAPSHOTS)
+        self.reset()
+        if path and os.path.exists(path):
+            self._load()
+
+    def reset(self):
+        """
+        Back to the allocations, before the genesis block
+        """
+        self.balances = dict(self.allocations)
+        #: address -> transactions sent
+        self.nonces = {}
+        self.height = 0
+        self.block_hash = ZERO_HASH
+        self._undo.clear()
+        self._snapshots.clear()
+
+    def balance(self, address):
+        return self.balances.get(address, 0)
+
+    def nonce(self, address):
+        """
+        :return: <Integer> the nonce of the next transaction of the address
+        """
+        return self.nonces.get(address, 0)
+
+    @staticmethod
+    def _spends(trx, balance):
+        amount = trx.amount
+        return isinstance(amount, int) and 0 <= amount <= balance
+
+    def admits(self, trx):
+        """
+        Whether the transaction may apply once the ones of the sender before
+        it did, e.g. to enter the mempool. O(1)
+        """
+        return trx.nonce >= self.nonce(trx.sender) and \
+            self._spends(trx, self.balance(trx.sender))
+
+    def apply(self, block):
+        """
+        Connect the block at the tip, all of its transactions or none
+        :return: <Bool> False if a transaction spends more than its sender
+                 has or is out of sequence
+        """
+        if block.index != self.height or \
+                (self.height and block.prev_hash != self.block_hash):
+            return False
+        undo = {}
+        for trx in block.transactions:
+            for address in (trx.sender, trx.recipient):
+                if address not in undo:
+                    undo[address] = (self.balances.get(address),
+                                     self.nonces.get(address))
+            balance = self.balance(trx.sender)
+            if trx.nonce != self.nonce(trx.sender) or \
+                    not self._spends(trx, balance):
+                self._restore(undo)
+                return False
+            self.balances[trx.sender] = balance - trx.amount
+            self.nonces[trx.sender] = trx.nonce + 1
+            self.balances[trx.recipient] = \
+                self.balance(trx.recipient) + trx.amount
+        self._undo.append((self.block_hash, undo))
+        self.height += 1
+        self.block_hash = block.hash
+        if self.height % SNAPSHOT_INTERVAL == 0:
+            self._snapshot()
+        return True
+
+    def _restore(self, undo):
+        for address, (balance, nonce) in undo.items():
+            for accounts, value in ((self.balances, balance),
+                                    (self.nonces, nonce)):
+                if value is None:
+                    accounts.pop(address, None)
+                else:
+                    accounts[address] = value
+
+    def rollback(self):
+        """
+        Disconnect the block at the tip
+        :return: <Bool> False if there is no undo record left for it
+        """
+        if not self._undo:
+            return False
+        self.block_hash, undo = self._undo.pop()
+        self._restore(undo)
+        self.height -= 1
+        while self._snapshots and self._snapshots[-1][0] > self.height:
+            self._snapshots.pop()
+        return True
+
+    @property
+    def snapshot_height(self):
+        """
+        The height of the latest snapshot, 0 if none
+        """
+        return self._snapshots[-1][0] if self._snapshots else 0
+
+    def reaches(self, height, first_body=0):
+        """
+        Whether rollback_to(height) can do without the blocks below
+        first_body, e.g. pruned
+        """
+        if self.height - len(self._undo) <= height or not first_body:
+            return True
+        return any(first_body <= snapshot[0] <= height
+                   for snapshot in self._snapshots)
+
+    def rollback_to(self, height, chain):
+        """
+        Disconnect the blocks from height on. Past the undo records, restart
+        from the latest snapshot below height, or the allocations, and
+        replay the blocks of the chain up to height
+        :param chain: <Chain> the state follows
+        """
+        while self.height > height:
+            if not self.rollback():
+                break
+        if self.height == height:
+            return
+        #: only snapshots of the blocks we keep are any good
+        while self._snapshots:
+            start, block_hash = self._snapshots[-1][:2]
+            if start <= height and chain.header(start-1).hash == block_hash:
+                break
+            self._snapshots.pop()
+        snapshots = list(self._snapshots)
+        self.reset()
+        self._snapshots.extend(snapshots)
+        if snapshots:
+            self.height, self.block_hash, balances, nonces = snapshots[-1]
+            self.balances, self.nonces = dict(balances), dict(nonces)
+        for idx in range(self.height, height):
+            self.apply(chain.blocks[idx])
+
+    def select(self, transactions):
+        """
+        The transactions that apply one after the other, e.g. for a block
+        :return: <list>
+        """
+        balances, nonces, selected = {}, {}, []
+        for trx in transactions:
+            sender = trx.sender
+            balance = balances.get(sender, self.balance(sender))
+            if trx.nonce != nonces.get(sender, self.nonce(sender)) or \
+                    not self._spends(trx, balance):
+                continue
+            balances[sender] = balance - trx.amount
+            nonces[sender] = trx.nonce + 1
+            balances[trx.recipient] = balances.get(
+                trx.recipient, self.balance(trx.recipient)) + trx.amount
+            selected.append(trx)
+        return selected
+
+    def _snapshot(self):
+        self._snapshots.append((self.height, self.block_hash,
+                                dict(self.balances), dict(self.nonces)))
+        if self.path:
+            self._save()
+
+    def _save(self):
+        """
+        Write the state, replacing the previous file only once complete
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'height': self.height, 'block_hash': self.block_hash,
+                       'balances': self.balances, 'nonces': self.nonces}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                doc = json.load(f)
+        except ValueError as e:
+            logging.warning('ignoring the state in %s: %s', self.path, e)
+            return
+        self.height, self.block_hash = doc['height'], doc['block_hash']
+        self.balances, self.nonces = doc['balances'], doc['nonces']
+        self._snapshots.append((self.height, self.block_hash,
+                                dict(self.balances), dict(self.nonces)))
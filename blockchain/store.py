@@ -0,0 +1,292 @@
+import mmap
+import os
+import re
+import shutil
+import struct
+import zlib
+
+from blockchain.block import Block, BlockHeader
+from blockchain.cache import LRUCache
+
+#: <length><crc32> in front of every record of the segment file
+RECORD_HEADER = struct.Struct('>II')
+#: an entry of the index file, the offset of the record of that height
+OFFSET = struct.Struct('>Q')
+#: a pruned segment file, named after the offset of its first record
+PRUNED_SEGMENT = re.compile(r'^blocks-(\d+)\.dat$')
+
+
+class PrunedError(LookupError):
+    """The body of a block a pruned store dropped"""
+
+
+class BlockStore(object):
+    """
+    Blocks on disk, used by Chain in place of a list. Records are only ever
+    appended to the segment file `blocks.dat`; `blocks.idx` holds the offset
+    of the record of every height in fixed-width entries and is memory mapped,
+    so opening the store does not read the blocks, they are loaded on access.
+    The headers are kept apart as well, in `headers.dat`.
+
+    A pruned store only keeps the bodies of the latest blocks. Once the
+    dropped records take as much room as the kept ones, the kept ones are
+    copied to a new segment `blocks-<offset>.dat`, named after the offset of
+    its first record, and the old one is deleted. Offsets stay those of the
+    whole history, so the index is never rewritten.
+    """
+
+    def __init__(self, path, cache_size=1024, keep=None):
+        """
+        :param keep: how many of the latest bodies the chain keeps, all of
+                     them if None
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.keep = keep
+        self._base, self._data = self._open_segment()
+        self._index = self._open(os.path.join(path, 'blocks.idx'))
+        self._headers = self._open(os.path.join(path, 'headers.dat'))
+        self._map = None
+        #: recently used blocks, by height
+        self._cache = LRUCache(cache_size)
+        self._recover()
+
+    @staticmethod
+    def _open(filename):
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        return open(filename, 'r+b')
+
+    def _open_segment(self):
+        """
+        The segment with the latest first record, the others are left over
+        from pruning
+        :return: (offset of its first record, file)
+        """
+        names = os.listdir(self.path)
+        bases = [int(match.group(1)) for match in
+                 map(PRUNED_SEGMENT.match, names) if match]
+        base = max(bases, default=0)
+        current = 'blocks-%d.dat' % base if base else 'blocks.dat'
+        for name in names:
+            if name != current and (name == 'blocks.dat' or name.endswith(
+                    '.dat.tmp') or PRUNED_SEGMENT.match(name)):
+                os.remove(os.path.join(self.path, name))
+        return base, self._open(os.path.join(self.path, current))
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._data.close()
+        self._index.close()
+        self._headers.close()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for height in range(self._count):
+            yield self[height]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[height] for height in range(*key.indices(len(self)))]
+        height = key + self._count if key < 0 else key
+        if not 0 <= height < self._count:
+            raise IndexError(key)
+        if height < self.pruned_height:
+            raise PrunedError('block %d is pruned, bodies are kept from '
+                              'height %d' % (height, self.pruned_height))
+        block = self._cache.get(height)
+        if not block:
+            block = Block.decode(self._read(self._offset(height))[1])
+            self._cache.put(height, block)
+        return block
+
+    def __delitem__(self, key):
+        """
+        Only `del store[height:]`, dropping the tail, is supported
+        """
+        if not isinstance(key, slice) or key.stop is not None:
+            raise TypeError('only the tail of the store can be deleted')
+        self.truncate(key.start)
+
+    def header(self, height):
+        """
+        :return: <BlockHeader> of the block at height, pruned or not
+        """
+        if not 0 <= height < self._count:
+            raise IndexError(height)
+        self._headers.seek(height * BlockHeader.SIZE)
+        return BlockHeader.decode(self._headers.read(BlockHeader.SIZE))
+
+    def headers(self, start, stop):
+        """
+        :return: <list> of <BlockHeader> of the blocks [start, stop), in one
+                 read
+        """
+        start, stop = max(start, 0), min(stop, self._count)
+        self._headers.seek(start * BlockHeader.SIZE)
+        data = self._headers.read(max(stop - start, 0) * BlockHeader.SIZE)
+        return [BlockHeader.decode(data[pos:pos + BlockHeader.SIZE])
+                for pos in range(0, len(data), BlockHeader.SIZE)]
+
+    def append(self, block):
+        """
+        Append a block, the record and the header go to disk before its
+        index entry
+        """
+        payload = block.encode()
+        self._data.seek(0, os.SEEK_END)
+        offset = self._base + self._data.tell()
+        self._data.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+                         + payload)
+        self._data.flush()
+        self._headers.seek(self._count * BlockHeader.SIZE)
+        self._headers.write(block.header.encode())
+        self._headers.flush()
+        self._index.seek(self._count * OFFSET.size)
+        self._index.write(OFFSET.pack(offset))
+        self._index.flush()
+        self._cache.put(self._count, block)
+        self._count += 1
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def truncate(self, height):
+        """
+        Drop the blocks from height on
+        """
+        if height >= self._count:
+            return
+        if height < self.pruned_height:
+            raise PrunedError('cannot truncate to %d, bodies are kept from '
+                              'height %d' % (height, self.pruned_height))
+        offset = self._offset(height)
+        for dropped in range(height, self._count):
+            self._cache.pop(dropped)
+        self._count = height
+        self._unmap()
+        self._index.truncate(height * OFFSET.size)
+        self._headers.truncate(height * BlockHeader.SIZE)
+        self._data.truncate(offset - self._base)
+
+    def prune(self, height):
+        """
+        Drop the bodies below height, the headers stay
+        """
+        if not self.pruned_height < height < self._count:
+            return
+        for dropped in range(self.pruned_height, height):
+            self._cache.pop(dropped)
+        self.pruned_height = height
+        offset = self._offset(height)
+        self._data.seek(0, os.SEEK_END)
+        dropped = offset - self._base
+        if dropped >= self._data.tell() - dropped:
+            self._compact(offset)
+
+    def _compact(self, offset):
+        """
+        Move the records from offset on to a segment of their own
+        """
+        name = os.path.join(self.path, 'blocks-%d.dat' % offset)
+        with open(name + '.tmp', 'wb') as f:
+            self._data.seek(offset - self._base)
+            shutil.copyfileobj(self._data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(name + '.tmp', name)
+        self._data.close()
+        os.remove(self._data.name)
+        self._base, self._data = offset, open(name, 'r+b')
+
+    def _map_index(self):
+        self._unmap()
+        if self._count:
+            self._map = mmap.mmap(self._index.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+
+    def _offset(self, height):
+        end = (height + 1) * OFFSET.size
+        if not self._map or len(self._map) < end:
+            #: appended since mapped
+            self._map_index()
+        return OFFSET.unpack_from(self._map, height * OFFSET.size)[0]
+
+    def _read(self, offset):
+        """
+        Read the record at offset
+        :return: (end offset, payload), payload is None for a torn or pruned
+                 record
+        """
+        if offset < self._base:
+            return offset, None
+        self._data.seek(offset - self._base)
+        header = self._data.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return offset, None
+        length, crc = RECORD_HEADER.unpack(header)
+        payload = self._data.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return offset, None
+        return offset + RECORD_HEADER.size + length, payload
+
+    def _recover(self):
+        """
+        Make the index and the segment agree after a crash: index entries
+        pointing at torn records are dropped, complete records missing from
+        the index get indexed and a torn tail record is truncated. The
+        headers missing, e.g. of a store older than the header file, are
+        written from the bodies.
+        """
+        self._index.seek(0, os.SEEK_END)
+        self._count = self._index.tell() // OFFSET.size
+        self._index.truncate(self._count * OFFSET.size)
+        self._map_index()
+        end = self._base
+        while self._count:
+            offset = self._offset(self._count - 1)
+            if offset < self._base:
+                #: the rest were pruned
+                break
+            end, payload = self._read(offset)
+            if payload is not None:
+                break
+            self._count -= 1
+            self._unmap()
+            self._index.truncate(self._count * OFFSET.size)
+            self._map_index()
+        while True:
+            record_end, payload = self._read(end)
+            if payload is None:
+                break
+            self._index.seek(self._count * OFFSET.size)
+            self._index.write(OFFSET.pack(end))
+            self._count, end = self._count + 1, record_end
+        self._index.flush()
+        self._data.truncate(end - self._base)
+        self._map_index()
+        #: the first height with a body in the segment
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._offset(mid) < self._base:
+                low = mid + 1
+            else:
+                high = mid
+        self.pruned_height = low
+        self._headers.seek(0, os.SEEK_END)
+        headers = min(self._headers.tell() // BlockHeader.SIZE, self._count)
+        self._headers.truncate(headers * BlockHeader.SIZE)
+        self._headers.seek(headers * BlockHeader.SIZE)
+        for height in range(headers, self._count):
+            self._headers.write(self[height].header.encode())
+        self._headers.flush()
@@ -0,0 +1,193 @@
+"""
+Headers-first chain sync. The headers after the common ancestor, found from
+a block locator, are fetched and checked first; the bodies then come in
+pages, from several peers at once, and are validated as they arrive.
+"""
+import json
+import logging
+from urllib.parse import urlencode
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+
+from blockchain.block import Block, BlockHeader, ZERO_HASH
+from blockchain.codec import BINARY, Reader
+from blockchain.transaction import Transaction
+
+#: headers asked for per request
+HEADERS_PER_REQUEST = 2000
+#: blocks per page of bodies
+PAGE_SIZE = 50
+#: pages fetched at once
+WINDOW = 8
+
+
+def decode_headers(data):
+    """
+    :return: <list> of <BlockHeader> from their concatenated encodings
+    """
+    return [BlockHeader.decode(data[pos:pos + BlockHeader.SIZE])
+            for pos in range(0, len(data), BlockHeader.SIZE)]
+
+
+def decode_blocks(data):
+    """
+    :return: <list> of <Block> from their length prefixed encodings
+    """
+    reader, blocks = Reader(data), []
+    while reader.pos < len(data):
+        blocks.append(Block.decode(reader.bytes()))
+    return blocks
+
+
+def _rotate(items, n):
+    n %= len(items)
+    return items[n:] + items[:n]
+
+
+class Syncer(object):
+    """
+    Catches a node up with the longest chain among its peers
+    """
+
+    def __init__(self, node, peers, page_size=PAGE_SIZE, window=WINDOW,
+                 timeout=10):
+        self.node = node
+        self.peers = peers
+        self.page_size = page_size
+        self.window = window
+        self.timeout = timeout
+
+    async def _get(self, url, binary=True):
+        headers = {'Accept': BINARY} if binary else {}
+        res = await AsyncHTTPClient().fetch(url, headers=headers,
+                                            request_timeout=self.timeout)
+        return res.body
+
+    async def _height(self, peer):
+        try:
+            body = await self._get(peer + '/chain/height/', binary=False)
+            return int(json.loads(body)['data'] or 0)
+        except Exception as e:
+            logging.warning('failed to get the height of %s: %s', peer, e)
+            return 0
+
+    async def headers(self, peer):
+        """
+        The headers of the peer after our common ancestor
+        """
+        headers, locator = [], self.node.chain.locator()
+        while True:
+            query = urlencode({'locator': ','.join(locator),
+                               'limit': HEADERS_PER_REQUEST})
+            batch = decode_headers(
+                await self._get(peer + '/headers/?' + query))
+            headers.extend(batch)
+            if len(batch) < HEADERS_PER_REQUEST:
+                return headers
+            locator = [batch[-1].hash]
+
+    def _check_headers(self, headers):
+        """
+        The headers have to follow one another from a block of ours and carry
+        their proof of work
+        """
+        fork, chain = headers[0].index, self.node.chain
+        if fork > chain.height:
+            return False
+        parent_hash = chain.header(fork-1).hash if fork else ZERO_HASH
+        for idx, header in enumerate(headers):
+            if header.index != fork + idx or header.prev_hash != parent_hash \
+                    or not Block.proof_of_work(header, Block.difficulty):
+                return False
+            parent_hash = header.hash
+        return True
+
+    @staticmethod
+    def _check_bodies(blocks, headers, vouched=0):
+        """
+        Every block has to match its header, the signatures of the whole page
+        are verified in one batch. The first vouched blocks, below a
+        checkpoint, only have to match their merkle root
+        """
+        if len(blocks) != len(headers):
+            return False
+        Transaction.verify_batch([trx for block in blocks[vouched:]
+                                  for trx in block.transactions])
+        return all(block.hash == header.hash and
+                   (block.body_matches() if idx < vouched else
+                    block.is_valid())
+                   for idx, (block, header) in enumerate(zip(blocks,
+                                                             headers)))
+
+    async def _page(self, sources, start, stop, headers, vouched=0):
+        """
+        Fetch blocks [start, stop) from the first source serving them
+        matching their headers, another source may be on another fork
+        :param headers: of the blocks
+        :param vouched: see _check_bodies
+        """
+        query = urlencode({'start': start, 'limit': stop - start})
+        for peer in sources:
+            try:
+                blocks = decode_blocks(
+                    await self._get(peer + '/block/?' + query))
+                if self._check_bodies(blocks, headers, vouched):
+                    return blocks
+                error = 'got %d blocks not matching the headers' % \
+                    len(blocks)
+            except Exception as e:
+                error = e
+            logging.warning('failed to get blocks %d-%d from %s: %s', start,
+                            stop, peer, error)
+        return []
+
+    async def sync(self):
+        """
+        :return: <Bool> whether the chain changed
+        """
+        chain = self.node.chain
+        heights = await gen.multi([self._height(peer) for peer in self.peers])
+        ranked = sorted(zip(heights, self.peers), key=lambda p: -p[0])
+        if not ranked or ranked[0][0] <= chain.height:
+            return False
+        best_height, best = ranked[0]
+        logging.info('found longer chain %d at %s. mine is %d', best_height,
+                     best, chain.height)
+        headers = await self.headers(best)
+        if not headers or not self._check_headers(headers):
+            logging.warning('invalid headers from %s', best)
+            return False
+        fork, end = headers[0].index, headers[-1].index + 1
+        if end <= chain.height:
+            return False
+        #: the blocks up to a checkpoint among the headers are vouched for
+        vouched_end = fork + chain.vouched(headers)
+        extending = fork == chain.height
+        #: any peer as high may serve bodies, the best one first
+        sources = [peer for height, peer in ranked if height >= end] or [best]
+        pages = [(start, min(start + self.page_size, end))
+                 for start in range(fork, end, self.page_size)]
+        switched = []
+        for first in range(0, len(pages), self.window):
+            window = pages[first:first + self.window]
+            #: spread the pages over the sources
+            results = await gen.multi([
+                self._page(_rotate(sources, idx), start, stop,
+                           headers[start-fork:stop-fork],
+                           min(max(vouched_end - start, 0), stop - start))
+                for idx, (start, stop) in enumerate(window, first)])
+            for (start, stop), blocks in zip(window, results):
+                if not blocks:
+                    logging.warning('no valid blocks %d-%d', start, stop)
+                    return start > fork and extending
+                vouched = min(max(vouched_end - start, 0), len(blocks))
+                if not extending:
+                    #: a fork, switched to once all of it is validated
+                    switched.extend(blocks)
+                    continue
+                if not self.node.extend(blocks, vouched):
+                    return start > fork
+        if not extending:
+            return self.node.switch(fork, switched)
+        return True
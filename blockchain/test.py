@@ -1,11 +1,40 @@
+import asyncio
+import contextlib
+import gzip
+import json
+import os
 import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
 sys.path.insert(0, '../')
 
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from blockchain import server
+from blockchain.broadcast import Broadcaster
 from blockchain.chain import Chain
-from blockchain.key import Key
-from blockchain.block import Block
+from blockchain import chain as chain_module
+from blockchain import metrics
+from blockchain.codec import BINARY, CodecError, pack_bytes
+from blockchain.compact import CompactBlock
+from blockchain.gossip import TRANSACTION, Gossip, encode_inv
+from blockchain.key import Key, PRECOMPUTE_AFTER
+from blockchain.block import Block, BlockHeader, ZERO_HASH
+from blockchain.mempool import Mempool
+from blockchain.miner import Miner, MiningWorker
 from blockchain.node import Node
-from blockchain.transaction import Transaction
+from blockchain.profiler import Profiler
+from blockchain.spv import LightClient, verify_inclusion
+from blockchain import state as state_module
+from blockchain.state import State
+from blockchain.store import BlockStore, PrunedError
+from blockchain.sync import Syncer, decode_blocks
+from blockchain.transaction import Transaction, verified_signatures
 
 
 def test_chain_init():
@@ -34,6 +63,14 @@ def test_key_sign():
     assert signature
 
 
+def test_key_sign_deterministic():
+    key = Key()
+    payload = 'Hello world'
+    #: RFC 6979, same data same signature
+    assert key.sign(payload, True) == key.sign(payload, True)
+    assert key.verify(payload, key.sign(payload, True))
+
+
 def test_key_verify():
     payload = 'Hello world'
     key = Key()
@@ -49,6 +86,18 @@ def test_public_verify():
     Key.verify_by_public_key(payload, signature, key.public_key)
 
 
+def test_key_cache():
+    key = Key()
+    assert Key(key.private_key)._private_key is \
+        Key(key.private_key)._private_key
+    payload = 'Hello world'
+    signature = key.sign(payload)
+    #: the tables are built for hot keys, verifying keeps working
+    for _ in range(PRECOMPUTE_AFTER + 1):
+        assert Key.verify_by_public_key(payload, signature, key.public_key)
+    assert not Key.verify_by_public_key('Hello', signature, key.public_key)
+
+
 def test_transaction_validation():
     sender, recipient = Key(), Key()
     trx = Transaction(sender.address, sender.public_key, recipient.address,
@@ -57,6 +106,80 @@ def test_transaction_validation():
     assert trx.is_valid()
 
 
+def test_transaction_sender_key():
+    alice, mallory = Key(), Key()
+    #: signed by mallory, spending from alice
+    trx = Transaction(alice.address, mallory.public_key, mallory.address,
+                      'steal', amount=10)
+    trx.sign(mallory.private_key)
+    assert not trx.is_valid()
+    assert Transaction.verify_batch([trx]) == [False]
+    node = Node(allocations={alice.address: 10})
+    node.init()
+    assert not node.add_transaction(trx)
+    assert node.state.balance(alice.address) == 10
+
+
+def test_transaction_verification_cache():
+    sender, recipient = Key(), Key()
+    trx = Transaction(sender.address, sender.public_key, recipient.address,
+                      'Hello world')
+    trx.sign(sender.private_key)
+    assert (trx.txid, trx.signature) not in verified_signatures
+    assert trx.is_valid()
+    assert (trx.txid, trx.signature) in verified_signatures
+    #: someone else's signature is neither cached nor valid
+    assert not tampered(trx, signature=Key().sign(trx.encode())).is_valid()
+    #: garbage makes it invalid, it does not raise
+    assert not tampered(trx, sender_key=sender.public_key[:20]).is_valid()
+    assert not Key.verify_by_public_key(trx.encode(), 'zz', sender.public_key)
+    assert not Key.verify_by_public_key(trx.encode(), trx.signature, 'zz')
+
+
+def tampered(trx, **changes):
+    """
+    A copy of a signed transaction with some fields changed
+    """
+    doc = trx.json(with_sign=True)
+    doc.update(changes)
+    return Transaction.from_json(doc)
+
+
+def test_transaction_immutable():
+    sender, recipient = Key(), Key()
+    trx = Transaction(sender.address, sender.public_key, recipient.address,
+                      'Hello world')
+    trx.payload = 'Hello'
+    trx.sign(sender.private_key)
+    assert trx.txid is trx.txid
+    try:
+        trx.payload = 'tampered'
+        assert False
+    except AttributeError:
+        pass
+    assert trx.is_valid() and trx.payload == 'Hello'
+
+
+def make_transactions(count):
+    sender, recipient = Key(), Key()
+    trxs = []
+    for idx in range(count):
+        trx = Transaction(sender.address, sender.public_key,
+                          recipient.address, 'Hello %d' % idx,
+                          nonce=idx)
+        trx.sign(sender.private_key)
+        trxs.append(trx)
+    return trxs
+
+
+def test_transaction_verify_batch():
+    trxs = make_transactions(40)
+    trxs[7] = tampered(trxs[7], signature=Key().sign(trxs[7].encode()))
+    results = Transaction.verify_batch(trxs, workers=2)
+    assert results == [idx != 7 for idx in range(40)]
+    assert (trxs[8].txid, trxs[8].signature) in verified_signatures
+
+
 def test_transaction_fromjson():
     sender, recipient = Key(), Key()
     trx = Transaction(sender.address, sender.public_key, recipient.address,
@@ -85,7 +208,90 @@ def test_block_fromjson():
     assert block.index == block2.index
 
 
-def make_chain():
+def test_block_zero_timestamp():
+    trx = make_transactions(1)[0]
+    #: the epoch is a timestamp like any other
+    block = Block(0, 0, [trx], timestamp=0)
+    assert block.timestamp == 0
+    assert Block.from_json(block.json()).hash == block.hash
+    assert Block.decode(block.encode()).hash == block.hash
+
+
+def test_block_merkle_root():
+    sender, recipient = Key(), Key()
+    trxs = []
+    for payload in ('Hello', 'world', '!'):
+        trx = Transaction(sender.address, sender.public_key,
+                          recipient.address, payload)
+        trx.sign(sender.private_key)
+        trxs.append(trx)
+    block = Node.mine_block(0, 0, trxs)
+    #: the header alone carries the proof of work
+    assert Block.proof_of_work(block.header, Block.difficulty)
+    block2 = Block.from_json(block.json())
+    assert block2.hash == block.hash and block2.is_valid()
+    #: tampering with a transaction breaks the commitment
+    block2.transactions[1] = tampered(block2.transactions[1],
+                                      payload='tampered')
+    assert not block2.is_valid()
+
+
+def test_block_codec():
+    block = make_chain(2).blocks[1]
+    data = block.encode()
+    block2 = Block.decode(data)
+    assert block2.hash == block.hash and block2.is_valid()
+    assert block2.json() == block.json()
+    assert len(block.header.encode()) == BlockHeader.SIZE
+    trx = block.transactions[0]
+    assert Transaction.decode(trx.encode(True)).txid == trx.txid
+    try:
+        Block.decode(data[:-1])
+        assert False
+    except CodecError:
+        pass
+
+
+def test_transaction_decode_canonical():
+    sender, recipient = Key(), Key()
+    trx = Transaction(sender.address, sender.public_key, recipient.address,
+                      {'b': 1, 'a': 2})
+    trx.sign(sender.private_key)
+    assert Transaction.decode(trx.encode(True)).txid == trx.txid
+    #: the same transaction, the signature still checks out
+    data = b''.join(pack_bytes(field) for field in (
+        bytes.fromhex(trx.sender), bytes.fromhex(trx.sender_key),
+        bytes.fromhex(trx.recipient), b'{"b":1,"a":2}')) + \
+        trx.encode()[-16:] + pack_bytes(bytes.fromhex(trx.signature))
+    try:
+        Transaction.decode(data)
+        assert False
+    except CodecError:
+        pass
+
+
+def test_parallel_mining():
+    miner = Miner(2)
+    block = Node.mine_block(0, 0, [], miner)
+    miner.close()
+    assert Block.proof_of_work(block, Block.difficulty)
+
+
+def test_mining_cancel():
+    miner = Miner(2)
+    threading.Timer(0.2, miner.cancel).start()
+    assert miner.mine(Block(0, 0, []), 64) is None
+    #: a new search starts afresh
+    assert miner.mine(Block(0, 0, []), 1)
+    #: unless cancelled since its template was made
+    generation = miner.generation
+    miner.cancel()
+    assert miner.mine(Block(0, 0, []), 1, generation=generation) is None
+    assert miner.mine(Block(0, 0, []), 1, generation=miner.generation)
+    miner.close()
+
+
+def make_chain(length=2):
     chain = Chain()
 
     sender, recipient = Key(), Key()
@@ -94,9 +300,9 @@ def make_chain():
     trx.sign(sender.private_key)
     genesis = Node.mine_block(0, 0, [trx])
     chain.add_block(genesis)
-    for _ in range(1, 2):
+    for nonce in range(1, length):
         trx = Transaction(sender.address, sender.public_key,
-                          recipient.address, "Hi")
+                          recipient.address, "Hi", nonce=nonce)
         trx.sign(sender.private_key)
         block = Node.mine_block(chain.height, chain.last_block.hash, [trx])
         chain.add_block(block)
@@ -107,6 +313,671 @@ def test_chain_validation():
     assert make_chain().is_valid()
 
 
+def test_chain_validated_height():
+    chain = make_chain(3)
+    assert chain.validated_height == 3
+    #: validated blocks are not looked at again
+    trxs = chain.blocks[1].transactions
+    trxs[0] = tampered(trxs[0], payload='tampered')
+    assert chain.is_valid()
+    chain.blocks = chain.blocks
+    assert not chain.is_valid()
+
+
+def test_chain_checkpoints():
+    blocks = make_chain(3).blocks
+    forged = tampered(blocks[1].transactions[0],
+                      signature=Key().sign(b'forged'))
+    blocks[1] = Node.mine_block(1, blocks[0].hash, [forged])
+    blocks[2] = Node.mine_block(2, blocks[1].hash, blocks[2].transactions)
+    checkpoints = {1: blocks[1].hash}
+    assert not Chain(blocks[:]).is_valid()
+    #: the signatures below a checkpoint are not checked, the bodies are
+    chain = Chain(blocks[:], checkpoints=checkpoints)
+    assert chain.is_valid() and chain.validated_height == 3
+    node = Node(checkpoints=checkpoints)
+    node.init(blocks)
+    assert node.chain.height == 3
+    node = Node()
+    node.init(blocks)
+    assert not node.chain.height
+    blocks[0].transactions[0] = tampered(blocks[0].transactions[0],
+                                         payload='tampered')
+    assert not Chain(blocks[:], checkpoints=checkpoints).is_valid()
+
+
+def test_chain_replace():
+    chain = make_chain(2)
+    longer = Chain(chain.blocks[:])
+    for _ in range(2):
+        longer.add_block(Node.mine_block(longer.height,
+                                         longer.last_block.hash, []))
+    assert chain.fork_point(longer.blocks) == 2
+    assert chain.replace(longer.blocks)
+    assert chain.height == 4 and chain.validated_height == 4
+    assert not chain.replace(longer.blocks[:3])
+
+
+def test_chain_fork():
+    chain = make_chain(3)
+    tip = chain.last_block
+    #: a competing block for the tip goes to a side branch
+    side = Node.mine_block(2, chain.blocks[1].hash, [])
+    assert chain.accept(side) == ([], [])
+    assert chain.knows(side.hash) and chain.last_block is tip
+    assert chain.accept(side) is None
+    #: unknown parent
+    assert chain.accept(Node.mine_block(4, 'f' * 64, [])) is None
+    #: the branch outgrows the chain
+    longer = Node.mine_block(3, side.hash, [])
+    assert chain.accept(longer) == ([tip], [side, longer])
+    assert [b.hash for b in chain.blocks[2:]] == [side.hash, longer.hash]
+    assert chain.validated_height == 4 and chain.knows(tip.hash)
+    assert not chain.find_transaction(tip.transactions[0].txid)
+    #: and back
+    back = Node.mine_block(3, tip.hash, [])
+    assert chain.add_block(back) is False
+    assert chain.add_block(Node.mine_block(4, back.hash, []))
+    assert chain.blocks[2] is tip and chain.height == 5
+
+
+def test_node_reorg():
+    trxs = make_transactions(2)
+    node = Node()
+    node.init()
+    genesis = node.chain.last_block
+    assert node.add_block(Node.mine_block(1, genesis.hash, trxs))
+    branch = [Node.mine_block(1, genesis.hash, [])]
+    branch.append(Node.mine_block(2, branch[0].hash, trxs[:1]))
+    assert not node.add_block(branch[0])
+    assert node.add_block(branch[1])
+    #: back to the pool, but for the one on the new branch
+    assert list(node.mempool) == trxs[1:]
+
+
+def payment(sender, recipient, amount, nonce):
+    trx = Transaction(sender.address, sender.public_key, recipient.address,
+                      'pay', amount=amount, nonce=nonce)
+    trx.sign(sender.private_key)
+    return trx
+
+
+def test_state(monkeypatch):
+    monkeypatch.setattr(state_module, 'SNAPSHOT_INTERVAL', 2)
+    alice, bob = Key(), Key()
+    chain = make_chain(1)
+    blocks = chain.blocks
+    state = State({alice.address: 10})
+    assert state.apply(blocks[0])
+    pay = payment(alice, bob, 7, 0)
+    assert state.admits(pay) and not state.admits(payment(alice, bob, 11, 0))
+    #: the second spends coins alice does not have anymore
+    assert state.select([pay, payment(alice, bob, 7, 1)]) == [pay]
+    blocks.append(Node.mine_block(1, blocks[0].hash,
+                                  [pay, payment(alice, bob, 7, 1)]))
+    assert not state.apply(blocks[1])
+    assert state.balance(alice.address) == 10 and state.height == 1
+    blocks[1] = Node.mine_block(1, blocks[0].hash, [pay])
+    blocks.append(Node.mine_block(2, blocks[1].hash,
+                                  [payment(bob, alice, 2, 0)]))
+    assert state.apply(blocks[1]) and state.apply(blocks[2])
+    assert (state.balance(alice.address), state.balance(bob.address)) == \
+        (5, 5)
+    assert state.nonce(bob.address) == 1 and not state.admits(pay)
+    state.rollback_to(1, chain)
+    assert (state.balance(alice.address), state.balance(bob.address)) == \
+        (10, 0) and state.nonce(alice.address) == 0
+    #: without undo records, replayed from the snapshot at height 2
+    assert state.apply(blocks[1]) and state.apply(blocks[2])
+    state._undo.clear()
+    state.rollback_to(2, chain)
+    assert state.balance(bob.address) == 7 and state.height == 2
+
+
+def test_node_state():
+    path = tempfile.mkdtemp()
+    alice, bob = Key(), Key()
+    node = Node(store=BlockStore(path), allocations={alice.address: 10})
+    node.init()
+    genesis = node.chain.last_block
+    spend = payment(alice, bob, 8, 0)
+    assert node.add_transaction(spend)
+    assert not node.add_transaction(payment(alice, bob, 11, 1))
+    assert node.next_nonce(alice.address) == 1
+    assert node.add_block(Node.mine_block(1, genesis.hash, [spend]))
+    assert node.state.balance(bob.address) == 8
+    #: a branch with more work spends the coins otherwise
+    double = payment(alice, alice, 9, 0)
+    branch = [Node.mine_block(1, genesis.hash, [double])]
+    branch.append(Node.mine_block(2, branch[0].hash, []))
+    assert not node.add_block(branch[0]) and node.add_block(branch[1])
+    assert node.state.balance(bob.address) == 0 and not len(node.mempool)
+    #: a branch spending more than there is does not get switched to
+    bad = [Node.mine_block(1, genesis.hash, [spend])]
+    bad.append(Node.mine_block(2, bad[0].hash, [payment(alice, bob, 3, 1)]))
+    bad.append(Node.mine_block(3, bad[1].hash, []))
+    for block in bad:
+        assert not node.add_block(block)
+    assert node.chain.last_block.hash == branch[1].hash
+    assert node.state.balance(alice.address) == 10
+    node.chain.blocks.close()
+    node = Node(store=BlockStore(path), allocations={alice.address: 10})
+    assert node.state.height == 3
+    assert node.state.nonce(alice.address) == 1
+
+
+def test_chain_indexes():
+    chain = make_chain(2)
+    block = chain.blocks[1]
+    trx = block.transactions[0]
+    assert chain.block_by_hash(block.hash) is block
+    assert chain.find_transaction(trx.txid) == (1, 0)
+    assert trx.txid in chain.transactions_of(trx.recipient)
+    assert len(chain.transactions_of(trx.sender)) == 2
+    #: a reorg drops the replaced blocks from the indexes
+    longer = Chain(chain.blocks[:1])
+    for _ in range(2):
+        longer.add_block(Node.mine_block(longer.height,
+                                         longer.last_block.hash, []))
+    assert chain.replace(longer.blocks)
+    assert not chain.block_by_hash(block.hash)
+    assert not chain.find_transaction(trx.txid)
+    assert chain.block_by_hash(longer.last_block.hash).index == 2
+
+
+def test_chain_lazy_indexes(monkeypatch):
+    path = tempfile.mkdtemp()
+    store = BlockStore(path)
+    for block in make_chain(5).blocks:
+        store.append(block)
+    store.close()
+    chain = Chain(BlockStore(path), validated=True)
+    decoded = []
+    decode = Block.decode
+    monkeypatch.setattr(Block, 'decode', staticmethod(
+        lambda data: decoded.append(data) or decode(data)))
+    #: the block index comes from the headers alone
+    block_hash = chain.header(2).hash
+    assert chain.knows(block_hash) and chain.locate([block_hash]) == 3
+    assert not decoded
+    trx = chain.block_by_hash(block_hash).transactions[0]
+    assert len(decoded) == 1
+    assert chain.find_transaction(trx.txid) == (2, 0)
+    assert len(decoded) == 5
+    chain.blocks.close()
+
+
+def test_chain_locator():
+    chain = make_chain(15)
+    locator = chain.locator()
+    assert locator[0] == chain.last_block.hash
+    assert locator[-1] == chain.blocks[0].hash
+    assert len(locator) < chain.height
+    assert chain.locate(locator) == 15
+    assert chain.locate(['f' * 64, chain.blocks[3].hash]) == 4
+    assert chain.locate([]) == 0
+
+
+@contextlib.asynccontextmanager
+async def serving(node, profiler=None):
+    """
+    Serve the api of node on an unused port, the module globals of the
+    server are restored afterwards
+    :return: <str> the url of the server
+    """
+    sock, port = bind_unused_port()
+    previous = server.node, server.profiler
+    server.node, server.profiler = node, profiler
+    http = HTTPServer(server.make_app())
+    http.add_sockets([sock])
+    try:
+        yield 'http://127.0.0.1:%d' % port
+    finally:
+        http.stop()
+        server.node, server.profiler = previous
+
+
+def sync_with(node, chain, **kwargs):
+    """
+    Sync node with a peer serving chain
+    """
+    remote = Node()
+    remote.init(chain.blocks)
+
+    async def sync():
+        async with serving(remote) as peer:
+            return await Syncer(node, [peer], **kwargs).sync()
+    return asyncio.run(sync())
+
+
+def test_sync():
+    remote = make_chain(5)
+    node = Node()
+    node.init(remote.blocks[:2])
+    assert sync_with(node, remote, page_size=2, window=2)
+    assert node.chain.height == 5
+    assert node.chain.last_block.hash == remote.last_block.hash
+    assert not sync_with(node, remote)
+
+
+def test_sync_fork():
+    remote = make_chain(5)
+    node = Node()
+    node.init(remote.blocks[:2] +
+              [Node.mine_block(2, remote.blocks[1].hash, [])])
+    assert sync_with(node, remote, page_size=2)
+    assert [b.hash for b in node.chain.blocks] == \
+        [b.hash for b in remote.blocks]
+
+
+def test_sync_sources():
+    remote, other = make_chain(5), make_chain(5)
+    node, forked = Node(), 'http://forked'
+    node.init(remote.blocks[:1])
+    served = Node()
+    served.init(remote.blocks)
+
+    class Forked(Syncer):
+        """
+        The second source is as high, on another chain
+        """
+        async def _get(self, url, binary=True):
+            if not url.startswith(forked):
+                return await super(Forked, self)._get(url, binary)
+            if '/chain/height/' in url:
+                return json.dumps({'data': other.height}).encode()
+            query = parse_qs(urlparse(url).query)
+            start = int(query['start'][0])
+            return b''.join(pack_bytes(block.encode()) for block in
+                            other.blocks[start:start + 1])
+
+    async def sync():
+        async with serving(served) as best:
+            return await Forked(node, [best, forked], page_size=1).sync()
+    assert asyncio.run(sync())
+    assert [b.hash for b in node.chain.blocks] == \
+        [b.hash for b in remote.blocks]
+
+
+def test_broadcast():
+    chain = make_chain(2)
+    node = Node()
+    node.init(chain.blocks[:1])
+
+    async def broadcast():
+        async with serving(node) as peer:
+            dead = 'http://127.0.0.1:1'
+            broadcaster = Broadcaster([peer, dead], queue_size=1, retries=1,
+                                      backoff=0.01)
+            assert broadcaster.send('/block/', chain.blocks[1].encode(),
+                                    {'Content-Type': BINARY}) == 2
+            #: the queue of the dead peer is full already
+            assert broadcaster.send('/chain/height/', b'', to=[dead]) == 0
+            await broadcaster.flush()
+        return broadcaster.peers
+    peer, dead = asyncio.run(broadcast())
+    assert node.chain.height == 2
+    assert peer.sent == 1 and dead.dropped == 2
+
+
+def test_gossip():
+    chain = make_chain(1)
+    trx, other = make_transactions(2)
+    pulled = []
+
+    class Counting(Gossip):
+        def pull(self, peer, items):
+            pulled.append((self.url, items))
+            return super(Counting, self).pull(peer, items)
+
+    async def gossip():
+        socks = [bind_unused_port() for _ in range(3)]
+        urls = ['http://127.0.0.1:%d' % port for _, port in socks]
+        nodes, servers = [], []
+        for (sock, _), url in zip(socks, urls):
+            node = Node()
+            node.init(chain.blocks)
+            node.gossip = Counting(node, Broadcaster(
+                [peer for peer in urls if peer != url]), url)
+            http = HTTPServer(tornado.web.Application(node.gossip.routes()))
+            http.add_sockets([sock])
+            nodes.append(node)
+            servers.append(http)
+        try:
+            nodes[0].add_transaction(trx)
+            nodes[0].gossip.announce_transaction(trx)
+            block = Node.mine_block(1, chain.last_block.hash, [trx])
+            nodes[0].add_block(block)
+            nodes[0].gossip.announce_block(block)
+            for _ in range(500):
+                if all(node.chain.height == 2 for node in nodes):
+                    break
+                await asyncio.sleep(0.01)
+            for node in nodes:
+                await node.gossip.broadcaster.flush()
+            #: only peers get pulled from
+            response = await AsyncHTTPClient().fetch(
+                urls[0] + '/inv/', method='POST', raise_error=False,
+                body=encode_inv([(TRANSACTION, other.txid)]),
+                headers={'X-Peer': 'http://127.0.0.1:1'})
+            assert response.code == 403
+            #: a peer answering with another object than the one asked for
+            nodes[0].gossip.lookup = lambda kind, obj_hash: trx.encode()
+            nodes[1].gossip.seen.put(other.txid, True)
+            await Gossip.pull(nodes[1].gossip, urls[0],
+                              [(TRANSACTION, other.txid)])
+            assert other.txid not in nodes[1].gossip.seen
+            nodes[0].gossip.lookup = lambda kind, obj_hash: b'garbage'
+            nodes[1].gossip.seen.put(other.txid, True)
+            await Gossip.pull(nodes[1].gossip, urls[0],
+                              [(TRANSACTION, other.txid)])
+            assert other.txid not in nodes[1].gossip.seen
+        finally:
+            for http in servers:
+                http.stop()
+        return nodes
+    nodes = asyncio.run(gossip())
+    assert all(node.chain.last_block.hash == nodes[0].chain.last_block.hash
+               for node in nodes)
+    #: announced ids are not pulled twice, nor echoed back
+    ids = [obj_hash for _, items in pulled for _, obj_hash in items]
+    assert len(ids) == len(set(zip(
+        [url for url, items in pulled for _ in items], ids)))
+    assert all(url != nodes[0].gossip.url for url, _ in pulled)
+
+
+def test_metrics():
+    verified = metrics.signatures_verified.get()
+    node = Node()
+    node.init()
+    for trx in make_transactions(3):
+        node.add_transaction(trx)
+    assert node.mine()
+    assert metrics.signatures_verified.get() == verified + 3
+    assert metrics.mining_hashes.get() > 0
+
+    async def scrape():
+        async with serving(node, Profiler(interval=0.001)) as url:
+            client = AsyncHTTPClient()
+            await client.fetch(url + '/profile/?enable=1', method='POST',
+                               body=b'')
+            await asyncio.sleep(0.05)
+            await client.fetch(url + '/profile/?enable=0', method='POST',
+                               body=b'')
+            stacks = (await client.fetch(url + '/profile/')).body.decode()
+            exposed = (await client.fetch(url + '/metrics')).body.decode()
+        return stacks, exposed
+    stacks, exposed = asyncio.run(scrape())
+    assert 'MainThread;' in stacks
+    assert all(line.rsplit(' ', 1)[1].isdigit()
+               for line in stacks.splitlines())
+    assert 'pok_chain_height 2\n' in exposed
+    assert 'pok_mempool_transactions 0\n' in exposed
+    assert 'pok_http_request_seconds_count{handler="ProfileHandler",' \
+        'method="POST"} 2\n' in exposed
+    assert 'pok_signature_verify_seconds_bucket{le="+Inf"}' in exposed
+
+
+def test_transaction_batch():
+    trxs = make_transactions(4)
+    node = Node()
+    node.init()
+    node.add_transaction(trxs[3])
+    garbage = [dict(trxs[0].json(with_sign=True), **change) for change in
+               ({'sender': 'zz'}, {'amount': -1}, {'amount': 1.5},
+                {'sender_key': trxs[0].sender_key[:20]})]
+    ndjson = b'\n'.join(json.dumps(doc).encode() for doc in
+                        [trx.json(with_sign=True) for trx in trxs[:2]] +
+                        garbage) + b'\n{"sender":\n'
+    binary = b''.join(pack_bytes(trx.encode(True)) for trx in
+                      [tampered(trxs[1], payload='tampered'), trxs[2],
+                       trxs[3]])
+
+    async def submit():
+        async with serving(node) as url:
+            results = []
+            for body, headers in ((ndjson, {}),
+                                  (binary, {'Content-Type': BINARY})):
+                res = await AsyncHTTPClient().fetch(
+                    url + '/transactions/', method='POST', body=body,
+                    headers=headers)
+                results.append([json.loads(line) for line in
+                                res.body.decode().splitlines()])
+            return results
+    as_json, as_binary = asyncio.run(submit())
+    assert [r['accepted'] for r in as_json] == [True, True] + [False] * 5
+    assert as_json[0]['txid'] == trxs[0].txid
+    #: the short key parses, its signature does not check out
+    assert [r['error'] for r in as_json[2:]] == ['malformed'] * 3 + \
+        ['invalid', 'malformed']
+    assert [r.get('error') for r in as_binary] == ['invalid', None,
+                                                   'rejected']
+    assert len(node.mempool) == 4
+
+
+def test_transaction_malformed():
+    sender, recipient = Key(), Key()
+    trx = make_transactions(1)[0]
+    doc = {'sender_addr': sender.address, 'sender_public': sender.public_key,
+           'recipient_addr': recipient.address, 'payload': 'hi',
+           'sender_private': sender.private_key}
+    bodies = [(trx.encode(True)[:-1], {'Content-Type': BINARY})] + [
+        (json.dumps(dict(doc, **change)), {}) for change in
+        ({'nonce': '1'}, {'nonce': 1.5}, {'amount': -1},
+         {'recipient_addr': 'zz'}, {'sender_private': 'ab'})] + \
+        [(b'[]', {}), (json.dumps(doc), {})]
+    node = Node()
+    node.init()
+
+    async def submit():
+        async with serving(node) as url:
+            return [(await AsyncHTTPClient().fetch(
+                url + '/transaction/', method='POST', body=body,
+                headers=headers, raise_error=False)).code
+                for body, headers in bodies]
+    assert asyncio.run(submit()) == [400] * 7 + [200]
+
+
+def test_block_pages():
+    chain = make_chain(5)
+    node = Node()
+    node.init(chain.blocks)
+
+    async def fetch():
+        client = AsyncHTTPClient()
+        async with serving(node) as url:
+            first = await client.fetch(
+                url + '/block/?limit=2', decompress_response=False,
+                headers={'Accept-Encoding': 'gzip'})
+            again = await client.fetch(
+                url + '/block/?limit=2', raise_error=False,
+                headers={'If-None-Match': first.headers['Etag']})
+            binary = await client.fetch(url + '/block/?start=3',
+                                        headers={'Accept': BINARY})
+            by_hash = await client.fetch(
+                url + '/block/%s/' % chain.blocks[1].hash)
+            bad = await client.fetch(url + '/block/?limit=two',
+                                     raise_error=False)
+            return first, again, binary, by_hash, bad
+    first, again, binary, by_hash, bad = asyncio.run(fetch())
+    assert bad.code == 400
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert first.headers['Link'] == '</block/?start=2&limit=2>; rel="next"'
+    data = json.loads(gzip.decompress(first.body))['data']
+    assert [Block.from_json(doc).hash for doc in data] == \
+        [b.hash for b in chain.blocks[:2]]
+    assert again.code == 304 and not again.body
+    assert 'Link' not in binary.headers
+    assert [b.hash for b in decode_blocks(binary.body)] == \
+        [b.hash for b in chain.blocks[3:]]
+    assert json.loads(by_hash.body)['data'] == chain.blocks[1].json()
+
+
+def test_merkle_proof():
+    trxs = make_transactions(5)
+    block = Block(1, ZERO_HASH, trxs)
+    for pos, trx in enumerate(trxs):
+        path = block.proof(pos)
+        assert len(path) <= 3
+        assert verify_inclusion(trx.txid, path, block.header)
+    assert not verify_inclusion(trxs[0].txid, block.proof(1), block.header)
+
+
+def test_light_client():
+    chain = make_chain(3)
+    trxs = make_transactions(5)
+    chain.add_block(Node.mine_block(3, chain.last_block.hash, trxs))
+    node = Node()
+    node.init(chain.blocks)
+
+    async def verify():
+        async with serving(node) as url:
+            client = LightClient(url)
+            assert await client.sync()
+            assert not await client.sync()
+            found = [await client.verify_transaction(trx.txid)
+                     for trx in trxs]
+            missing = await client.verify_transaction('f' * 64)
+            #: a forged header does not vouch for anything
+            client.headers[3] = BlockHeader(3, chain.blocks[2].hash,
+                                            ZERO_HASH, 0)
+            forged = await client.verify_transaction(trxs[0].txid)
+        return found, missing, forged
+    found, missing, forged = asyncio.run(verify())
+    assert found == [3] * 5 and missing is None and forged is None
+
+
+def test_compact_block():
+    trxs = make_transactions(5)
+    block = Block(1, ZERO_HASH, trxs)
+    compact = CompactBlock.decode(CompactBlock.from_block(block).encode())
+    assert compact.hash == block.hash
+    assert len(compact.encode()) < len(block.encode()) // 10
+    matched = compact.match(trxs[1:] + make_transactions(2))
+    assert matched[0] is None and matched[1:] == trxs[1:]
+    assert not compact.block(trxs[1:] + trxs[:1])
+    assert compact.block(trxs).hash == block.hash
+
+    chain = make_chain(1)
+    fetched = metrics.compact_blocks.get(result='fetched')
+    missing = metrics.compact_missing.get()
+
+    async def relay():
+        socks = [bind_unused_port() for _ in range(2)]
+        urls = ['http://127.0.0.1:%d' % port for _, port in socks]
+        nodes, servers = [], []
+        for (sock, _), url in zip(socks, urls):
+            node = Node()
+            node.init(chain.blocks)
+            node.gossip = Gossip(node, Broadcaster(
+                [peer for peer in urls if peer != url]), url)
+            http = HTTPServer(tornado.web.Application(node.gossip.routes()))
+            http.add_sockets([sock])
+            nodes.append(node)
+            servers.append(http)
+        try:
+            for trx in trxs[1:]:
+                nodes[1].add_transaction(trx)
+            nodes[0].add_block(block_of_trxs)
+            nodes[0].gossip.announce_block(block_of_trxs)
+            for _ in range(500):
+                if nodes[1].chain.height == 2:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            for http in servers:
+                http.stop()
+        return nodes[1]
+    block_of_trxs = Node.mine_block(1, chain.last_block.hash, trxs)
+    node = asyncio.run(relay())
+    assert node.chain.last_block.hash == block_of_trxs.hash
+    assert not len(node.mempool)
+    assert metrics.compact_blocks.get(result='fetched') == fetched + 1
+    assert metrics.compact_missing.get() == missing + 1
+
+
+def test_compact_block_checks():
+    peer = 'http://127.0.0.1:1'
+    node = Node()
+    node.init()
+    node.gossip = Gossip(node, Broadcaster([peer]), 'http://127.0.0.1:2')
+    block = Block(1, node.chain.last_block.hash, make_transactions(2))
+    while Block.proof_of_work(block, Block.difficulty):
+        block = Block(1, block.prev_hash, block.transactions,
+                      block.nonce + 1)
+    #: no work behind it, nothing gets fetched for it
+    assert not node.gossip.receive_compact(peer,
+                                           CompactBlock.from_block(block))
+
+    async def post():
+        sock, port = bind_unused_port()
+        http = HTTPServer(tornado.web.Application(node.gossip.routes()))
+        http.add_sockets([sock])
+        try:
+            return [(await AsyncHTTPClient().fetch(
+                'http://127.0.0.1:%d%s' % (port, path), method='POST',
+                body=body, headers={'X-Peer': peer},
+                raise_error=False)).code
+                for path, body in (('/cmpctblock/', b'\0' * 10),
+                                   ('/blocktxn/', b'\0' * 33),
+                                   ('/inv/', b'\1'))]
+        finally:
+            http.stop()
+    assert asyncio.run(post()) == [400] * 3
+
+
+def test_mempool():
+    trxs = make_transactions(4)
+    size = len(trxs[0].encode(True))
+    mempool = Mempool(max_count=3, max_bytes=10 * size)
+    assert all(mempool.add(trx) for trx in trxs)
+    assert not mempool.add(trxs[3])
+    #: the oldest got evicted
+    assert len(mempool) == 3 and trxs[0].txid not in mempool
+    assert mempool.bytes == 3 * size
+    assert mempool.template(BlockHeader.SIZE + 4 + 2 * (size + 4)) == \
+        trxs[1:3]
+    mempool.expire(now=time.time() + mempool.max_age + 1)
+    assert not len(mempool) and not mempool.bytes
+
+
+def test_node_mempool():
+    node = Node()
+    node.init()
+    trxs = make_transactions(4)
+    assert all(node.add_transaction(trx) for trx in trxs)
+    assert not node.add_transaction(trxs[0])
+    block = node.mine()
+    assert block.transactions == trxs and not len(node.mempool)
+    #: included already
+    assert not node.add_transaction(trxs[0])
+    #: a peer's block takes its transactions out of the pool
+    peer = Node()
+    peer.init(node.chain.blocks[:1])
+    peer.add_transaction(trxs[0])
+    assert peer.add_block(block) and not len(peer.mempool)
+
+
+def test_mining_worker():
+    node = Node()
+    node.init()
+    found = []
+
+    async def mine():
+        worker = MiningWorker(node, on_block=found.append)
+        node.worker = worker
+        worker.start()
+        for trx in make_transactions(3):
+            node.add_transaction(trx)
+        while not found:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        return worker.status()
+    status = asyncio.run(mine())
+    assert status['found'] == 1 and not status['mining']
+    assert node.chain.last_block is found[0] and not len(node.mempool)
+
+
 def test_node_init_genesis():
     node = Node()
     node.init()
@@ -117,3 +988,124 @@ def test_node_init_sync():
     node = Node()
     node.init(chain.blocks)
     assert len(node.chain.blocks) == len(chain.blocks)
+
+
+def test_block_store():
+    path = tempfile.mkdtemp()
+    blocks = make_chain(3).blocks
+    store = BlockStore(path)
+    store.extend(blocks)
+    store.close()
+    store = BlockStore(path)
+    assert len(store) == 3
+    assert [b.hash for b in store] == [b.hash for b in blocks]
+    assert store[-1].transactions[0].txid == blocks[-1].transactions[0].txid
+    del store[2:]
+    assert len(store) == 2
+    store.append(blocks[2])
+    store.close()
+    #: a torn tail record is truncated on open
+    with open(os.path.join(path, 'blocks.dat'), 'r+b') as f:
+        f.truncate(os.path.getsize(f.name) - 3)
+    store = BlockStore(path)
+    assert len(store) == 2 and store[1].hash == blocks[1].hash
+    store.close()
+
+
+def test_block_store_pruned():
+    path = tempfile.mkdtemp()
+    blocks = make_chain(6).blocks
+    store = BlockStore(path, keep=2)
+    store.extend(blocks)
+    store.prune(4)
+    assert store.pruned_height == 4 and len(store) == 6
+    try:
+        store[3]
+        assert False
+    except PrunedError:
+        pass
+    assert store.header(0).hash == blocks[0].hash
+    #: the dropped records took more room than the kept ones
+    assert 'blocks.dat' not in os.listdir(path)
+    store.close()
+    store = BlockStore(path, keep=2)
+    assert store.pruned_height == 4 and store[5].hash == blocks[5].hash
+    assert [store.header(h).hash for h in range(6)] == \
+        [b.hash for b in blocks]
+    try:
+        del store[3:]
+        assert False
+    except PrunedError:
+        pass
+    del store[5:]
+    store.append(blocks[5])
+    assert store[-1].hash == blocks[-1].hash
+    store.close()
+
+
+def test_node_pruned(monkeypatch):
+    monkeypatch.setattr(chain_module, 'MAX_FORK_DEPTH', 2)
+    monkeypatch.setattr(state_module, 'SNAPSHOT_INTERVAL', 6)
+    path = tempfile.mkdtemp()
+    trx = make_transactions(1)[0]
+    node = Node(store=BlockStore(path, keep=3))
+    node.init()
+    genesis = node.chain.last_block
+    for height in range(1, 10):
+        node.add_block(Node.mine_block(height, node.chain.last_block.hash,
+                                       [trx] if height == 1 else []))
+    chain = node.chain
+    #: 7 leaves the latest 3, but the state replays from its snapshot at 6
+    assert chain.height == 10 and chain.pruned_height == 6
+    assert chain.knows(genesis.hash) and not chain.find_transaction(trx.txid)
+    assert chain.locate(chain.locator()) == 10
+    try:
+        chain.block_by_hash(genesis.hash)
+        assert False
+    except PrunedError:
+        pass
+    #: too deep to switch to
+    assert not node.switch(2, [Node.mine_block(2, chain.header(1).hash, [])])
+    assert not node.add_block(Node.mine_block(2, chain.header(1).hash, []))
+
+    async def fetch():
+        client = AsyncHTTPClient()
+        async with serving(node) as url:
+            page = await client.fetch(url + '/block/?start=2',
+                                      raise_error=False)
+            by_hash = await client.fetch(url + '/block/%s/' % genesis.hash,
+                                         raise_error=False)
+            headers = await client.fetch(url + '/headers/')
+            lookup = await client.fetch(url + '/transaction/%s/' % trx.txid,
+                                        raise_error=False)
+            address = await client.fetch(url + '/address/%s/' % trx.sender)
+            return page, by_hash, headers, lookup, address
+    page, by_hash, headers, lookup, address = asyncio.run(fetch())
+    assert page.code == by_hash.code == lookup.code == 410
+    assert json.loads(address.body) == {'code': 0, 'data': [],
+                                        'pruned_height': 6}
+    assert page.reason == 'blocks below 6 are pruned'
+    assert len(headers.body) == 10 * BlockHeader.SIZE
+    node.chain.blocks.close()
+    node = Node(store=BlockStore(path, keep=3))
+    assert node.chain.pruned_height == 6 and node.state.height == 10
+    assert node.state.nonce(trx.sender) == 1
+    #: the first block we still have the body of can be switched away
+    fork = [Node.mine_block(6, node.chain.header(5).hash, [])]
+    for height in range(7, 12):
+        fork.append(Node.mine_block(height, fork[-1].hash, []))
+    assert node.switch(6, fork)
+    assert node.chain.last_block.hash == fork[-1].hash
+    assert node.state.height == 12
+
+
+def test_node_store():
+    path = tempfile.mkdtemp()
+    node = Node(store=BlockStore(path))
+    node.init()
+    genesis = node.chain.last_block
+    node.chain.blocks.close()
+    node = Node(store=BlockStore(path))
+    node.init()
+    assert node.chain.height == 1 and node.chain.validated_height == 1
+    assert node.chain.last_block.hash == genesis.hash
@@ -1,20 +1,52 @@
 import binascii
 import json
+import _sha256
 
+from blockchain import metrics
+from blockchain.cache import LRUCache
+from blockchain.codec import U64, CodecError, Reader, pack_bytes
 from blockchain.key import ADDRESS_MAGIC_BYTE, Key
 
+#: (txid, signature) pairs whose signature checked out. Shared by every
+#: transaction, so a transaction admitted to the mempool is not verified again
+#: when it is mined, validated within a block or within the chain.
+verified_signatures = LRUCache(100000)
+
 
 class Transaction(object):
     """
-    A transaction. Only check the authentication
+    A transaction. Moves amount from the sender to the recipient, its nonce
+    is the count of the sender's transactions before it. Only checks the
+    authentication, the State checks the rest. Immutable once signed, so its
+    encodings and txid are only ever computed once.
     """
+    __slots__ = ('sender', 'recipient', 'payload', 'signature', 'sender_key',
+                 'amount', 'nonce', '_unsigned', '_signed', '_txid')
+
     def __init__(self, sender: str, sender_key: str, recipient: str,
-                 payload: object, signature=None):
-        self.sender = sender
-        self.recipient = recipient
-        self.payload = payload
-        self.signature = signature
-        self.sender_key = sender_key
+                 payload: object, signature=None, amount=0, nonce=0):
+        #: bypasses the immutability check, there is nothing to check yet
+        init = object.__setattr__
+        init(self, 'sender', sender)
+        init(self, 'recipient', recipient)
+        init(self, 'payload', payload)
+        init(self, 'sender_key', sender_key)
+        init(self, 'amount', amount)
+        init(self, 'nonce', nonce)
+        init(self, 'signature', signature)
+        init(self, '_unsigned', None)
+        init(self, '_signed', None)
+        init(self, '_txid', None)
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_'):
+            if getattr(self, 'signature', None) is not None:
+                raise AttributeError('a signed transaction is immutable')
+            #: forget the memoized encodings
+            object.__setattr__(self, '_unsigned', None)
+            object.__setattr__(self, '_signed', None)
+            object.__setattr__(self, '_txid', None)
+        object.__setattr__(self, name, value)
 
     @staticmethod
     def from_json(doc):
@@ -25,25 +57,120 @@ class Transaction(object):
             'sender': self.sender,
             'recipient': self.recipient,
             'payload': self.payload,
-            'sender_key': self.sender_key
+            'sender_key': self.sender_key,
+            'amount': self.amount,
+            'nonce': self.nonce
         }
         if with_sign:
             doc['signature'] = self.signature
         return doc
 
-    def sign(self, private_key):
-        payload = json.dumps(self.json(), sort_keys=True, ensure_ascii=False)
-        self.signature = Key(private_key).sign(payload)
+    def encode(self, with_sign=False):
+        """
+        The canonical binary encoding, signed without the signature
+        :return: <bytes>
+        """
+        if self._unsigned is None:
+            payload = json.dumps(self.payload, sort_keys=True,
+                                 ensure_ascii=False)
+            self._unsigned = pack_bytes(bytes.fromhex(self.sender)) + \
+                pack_bytes(bytes.fromhex(self.sender_key)) + \
+                pack_bytes(bytes.fromhex(self.recipient)) + \
+                pack_bytes(payload.encode('utf8')) + \
+                U64.pack(self.amount) + U64.pack(self.nonce)
+        if not with_sign:
+            return self._unsigned
+        if self._signed is None:
+            self._signed = self._unsigned + \
+                pack_bytes(bytes.fromhex(self.signature))
+        return self._signed
+
+    @staticmethod
+    def decode(data):
+        """
+        Decode a signed transaction
+        :raise CodecError: for malformed data, or not the canonical
+               encoding
+        """
+        reader = Reader(data)
+        sender, sender_key, recipient = reader.bytes().hex(), \
+            reader.bytes().hex(), reader.bytes().hex()
+        payload = json.loads(reader.bytes().decode('utf8'))
+        amount, nonce = reader.u64(), reader.u64()
+        signature = reader.bytes().hex()
+        reader.done()
+        trx = Transaction(sender, sender_key, recipient, payload, signature,
+                          amount, nonce)
+        #: the signature covers the canonical encoding, the txid has to as
+        #: well or the same transaction could go by many of them
+        if trx.encode(True) != data:
+            raise CodecError('transaction not canonically encoded')
+        return trx
+
+    @property
+    def txid(self):
+        """
+        Hash of the signed transaction, also its leaf in the merkle tree
+        :return: <str>
+        """
+        if self._txid is None:
+            self._txid = _sha256.sha256(self.encode(True)).hexdigest()
+        return self._txid
+
+    def sign(self, private_key, deterministic=False):
+        """
+        Sign it, which freezes it
+        :param deterministic: see Key.sign
+        """
+        self.signature = Key(private_key).sign(self.encode(), deterministic)
         return self.signature
 
+    def _addresses_valid(self):
+        """
+        The sender must be the address of the key that signs, or anyone
+        could spend from it
+        """
+        return self.sender == ADDRESS_MAGIC_BYTE.hex() + self.sender_key \
+            and binascii.unhexlify(self.recipient)\
+            .startswith(ADDRESS_MAGIC_BYTE)
+
     def is_valid(self):
         """
-        Check validity. addresses must be valid
+        Check validity. addresses must be valid, the sender's being the one
+        of the sender key
         :return:
         """
-        payload = json.dumps(self.json(), sort_keys=True, ensure_ascii=False)
-        return binascii.unhexlify(self.sender).startswith(ADDRESS_MAGIC_BYTE) \
-            and binascii.unhexlify(self.recipient)\
-            .startswith(ADDRESS_MAGIC_BYTE) and \
-            Key.verify_by_public_key(payload, signature=self.signature,
-                                     public_key=self.sender_key)
+        return Transaction.verify_batch([self], workers=1)[0]
+
+    @staticmethod
+    def verify_batch(transactions, workers=None):
+        """
+        Check the validity of many transactions, the signatures missing from
+        the cache are verified in parallel
+        :param workers: see Key.verify_batch
+        :return: <list> of <Bool>, in the order of transactions
+        """
+        results, pending = [], []
+        for idx, trx in enumerate(transactions):
+            if not trx._addresses_valid():
+                results.append(False)
+            elif (trx.txid, trx.signature) in verified_signatures:
+                results.append(True)
+            else:
+                results.append(None)
+                pending.append(idx)
+        metrics.signature_cache_hits.inc(results.count(True))
+        verdicts = []
+        if pending:
+            with metrics.signature_verify_seconds.time():
+                verdicts = Key.verify_batch(
+                    [(transactions[idx].encode(), transactions[idx].signature,
+                      transactions[idx].sender_key) for idx in pending],
+                    workers)
+            metrics.signatures_verified.inc(len(pending))
+        for idx, valid in zip(pending, verdicts):
+            if valid:
+                trx = transactions[idx]
+                verified_signatures.put((trx.txid, trx.signature), True)
+            results[idx] = valid
+        return results
@@ -9,7 +9,10 @@ class Node(object):
     """
 
     def __init__(self, data=None):
-        self.val = data is not None and sha256(data).hexdigest() or None
+        if isinstance(data, str):
+            self.val = sha256(data.encode('utf8')).hexdigest()
+        else:
+            self.val = data is not None and sha256(data).hexdigest() or None
         self.l = None
         self.data = data
         # height
@@ -28,12 +31,29 @@ class MerkleTree(object):
         self.root = None
         self.build()
 
+    @staticmethod
+    def from_hashes(hashes):
+        """
+        Build the tree from the hashes of the data rather than the data
+        """
+        tree = MerkleTree()
+        for val in hashes:
+            leaf = Node()
+            leaf.val = val
+            tree.leaves.append(leaf)
+        tree.build()
+        return tree
+
     def build(self):
         """
         Build up the whole tree from the leaves
         """
         # copy the leaves
         height, layer = 0, self.leaves[::]
+        if not layer:
+            # nothing to commit to
+            self.root = None
+            return
         # reduce the leaves to exactly one node
         while len(layer) != 1:
             layer = self._build(layer, height)
@@ -85,6 +105,31 @@ class MerkleTree(object):
         self.leaves.append(Node(data))
         self.build()
 
+    def proof(self, pos):
+        """
+        The audit path of the leaf at pos: the hashes it gets combined with
+        on its way up to the root, and on which side they are. Promoted
+        orphans are combined with nothing on their way up.
+        :return: <list> of (hash, 'l' or 'r')
+        """
+        path, node = [], self.leaves[pos]
+        while node.p:
+            if node.p.l is node:
+                path.append((node.p.r.val, 'r'))
+            else:
+                path.append((node.p.l.val, 'l'))
+            node = node.p
+        return path
+
+    @staticmethod
+    def verify_proof(val, path, root):
+        """
+        Check an audit path of the leaf hash val against the root hash
+        """
+        for sibling, side in path:
+            val = Node(sibling + val if side == 'l' else val + sibling).val
+        return val == root
+
     def echo(self):
         """
         print the tree
@@ -134,3 +179,6 @@ if __name__ == '__main__':
     tree.echo()
     # contains
     print(tree.contains('你', 2))
+    # audit path
+    print(MerkleTree.verify_proof(tree.leaves[2].val, tree.proof(2),
+                                  tree.root.val))